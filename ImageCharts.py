@@ -2,45 +2,1112 @@
 
 # Compatible with Python 3.6+
 
-from urllib.parse import urlencode, quote_plus
-import hmac, hashlib, codecs, json
-from base64 import b64encode
-import requests
+from urllib.parse import quote_plus
+import threading, time, os, weakref
+from collections import namedtuple, OrderedDict
+from itertools import islice
+from types import MappingProxyType
+
+# requests, aiohttp, asyncio, hmac, json and the executors are imported by the functions using them,
+# so that importing the module to build urls stays cheap
+
+class ImageChartsError(Exception):
+  """Base class of the errors raised when a chart can not be rendered
+
+  - status_code :int - HTTP status code of the response (None when no response was received)
+  - error_code :str - x-ic-error-code response header, or HTTP_<status_code>
+  - headers :dict - response headers
+  """
+
+  retryable = False
+
+  def __init__(self, status_code=None, error_code=None, headers=None, message=None, validation_messages=None) -> None:
+    super().__init__(status_code, error_code)
+    self.status_code = status_code
+    self.error_code = error_code
+    self.headers = headers if headers is not None else {}
+    self._message = message
+    self._validation_messages = validation_messages
+
+  @property
+  def validation_messages(self):
+    """Every message of the x-ic-error-validation response header (decoded on first access)"""
+    if self._validation_messages is None:
+      import json
+      raw = self.headers.get('x-ic-error-validation', '')
+      try:
+        decoded = json.loads(raw) if raw else []
+      except ValueError:
+        decoded = []
+      self._validation_messages = [item['message'] for item in decoded if isinstance(item, dict) and 'message' in item]
+    return self._validation_messages
+
+  def __str__(self):
+    if self._message is not None:
+      return self._message
+    messages = self.validation_messages
+    return messages[0] if messages else str(self.error_code)
+
+  def __reduce__(self):
+    # headers are usually a case-insensitive mapping, they are pickled as a dict of lower-case names
+    headers = {name.lower(): value for name, value in self.headers.items()}
+    return (self.__class__, (self.status_code, self.error_code, headers, self._message, self._validation_messages))
+
+class ImageChartsValidationError(ImageChartsError):
+  """The chart parameters are invalid (HTTP 4xx, or local validation when status_code is None)"""
+
+class ImageChartsAuthError(ImageChartsError):
+  """The account or the request signature was rejected (HTTP 401 / 403)"""
+
+class ImageChartsRateLimitError(ImageChartsError):
+  """Too many requests (HTTP 429)"""
+
+  retryable = True
+
+  @property
+  def retry_after(self):
+    """Retry-After response header, as sent by the server (None when missing)"""
+    return self.headers.get('retry-after')
+
+class ImageChartsServerError(ImageChartsError):
+  """Image-Charts failed to render the chart (HTTP 5xx)"""
+
+  retryable = True
+
+class ImageChartsTimeoutError(ImageChartsError):
+  """No response was received before the timeout"""
+
+  retryable = True
+
+class ImageChartsConnectionError(ImageChartsError):
+  """Image-Charts could not be reached"""
+
+  retryable = True
+
+def _error_for_response(status_code, headers):
+  error_code = headers.get('x-ic-error-code', 'HTTP_{}'.format(status_code))
+  if status_code == 429:
+    error_class = ImageChartsRateLimitError
+  elif status_code in (401, 403):
+    error_class = ImageChartsAuthError
+  elif status_code >= 500:
+    error_class = ImageChartsServerError
+  elif status_code >= 400:
+    error_class = ImageChartsValidationError
+  else:
+    error_class = ImageChartsError
+  return error_class(status_code, error_code, headers)
+
+_CHART_TYPES = frozenset((
+  'bvs', 'bvg', 'bhs', 'bhg', 'bvo', 'p', 'p3', 'pc', 'pd', 'ls', 'lc', 'lxy', 'ls:nda', 'lc:nda', 'lxy:nda', 'pa', 'bb',
+  'gv', 'gv:dot', 'gv:neato', 'gv:circo', 'gv:fdp', 'gv:osage', 'gv:twopi', 'qr', 'r'
+))
+_LABEL_CHART_TYPES = frozenset(cht for cht in _CHART_TYPES if cht == 'qr' or cht.startswith('gv'))
+_MAX_CHART_SIDE = 999
+
+_PATTERNS = {}
+
+def _patterns():
+  """Validation regexes, compiled on first use"""
+  if not _PATTERNS:
+    import re
+    number = r'-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?'
+    color = r'[0-9A-Fa-f]{6}(?:[0-9A-Fa-f]{2})?'
+    _PATTERNS.update({
+      'chs': re.compile(r'^(\d+)x(\d+)$'),
+      'chd': {
+        't': re.compile(r'^t\d*:(?:{value})(?:,(?:{value}))*(?:\|(?:{value})(?:,(?:{value}))*)*$'.format(value=number + '|_')),
+        'a': re.compile(r'^a\d*:(?:{value})(?:,(?:{value}))*(?:\|(?:{value})(?:,(?:{value}))*)*$'.format(value=number + '|_')),
+        's': re.compile(r'^s\d*:[A-Za-z0-9_]*(?:,[A-Za-z0-9_]*)*$'),
+        'e': re.compile(r'^e\d*:(?:[A-Za-z0-9\-._]{2})*(?:,(?:[A-Za-z0-9\-._]{2})*)*$')
+      },
+      'chco': re.compile(r'^{color}(?:[,|]{color})*$'.format(color=color)),
+      'chf': re.compile(r'^(?:bg|c|a|b\d+|ps\d+-\d+),(?:s,{color}|l[gs],{number}(?:,{color},{number})+)$'.format(color=color, number=number))
+    })
+  return _PATTERNS
+
+def validate_query(query, secret=None):
+  """Check chart parameters locally, without any request, and return the list of error messages (empty when valid)
+
+  - query :dict - chart parameters, like ImageCharts().query
+  - secret :str - secret key option, required to sign charts using icac
+  """
+  messages = []
+  patterns = _patterns()
+
+  cht = query.get('cht')
+  if cht is None:
+    messages.append('"cht" is required')
+  elif cht not in _CHART_TYPES:
+    messages.append('"cht" must be one of {types}'.format(types=', '.join(sorted(_CHART_TYPES))))
+
+  chs = query.get('chs')
+  if chs is None:
+    messages.append('"chs" is required')
+  else:
+    match = patterns['chs'].match(str(chs))
+    if match is None:
+      messages.append('"chs" must be formatted as <width>x<height>')
+    else:
+      # 999x999 is also the 998,001 pixels maximum area
+      width, height = int(match.group(1)), int(match.group(2))
+      if not 0 < width <= _MAX_CHART_SIDE or not 0 < height <= _MAX_CHART_SIDE:
+        messages.append('"chs" width and height must be between 1 and {side} pixels'.format(side=_MAX_CHART_SIDE))
+
+  if cht in _LABEL_CHART_TYPES:
+    if 'chl' not in query:
+      messages.append('"chl" is required by "cht={cht}" charts'.format(cht=cht))
+  elif 'chd' not in query:
+    messages.append('"chd" is required')
+
+  chd = query.get('chd')
+  if chd is not None:
+    pattern = patterns['chd'].get(str(chd)[:1])
+    if pattern is None or pattern.match(str(chd)) is None:
+      messages.append('"chd" must use the text (t:), auto-scaled (a:), simple (s:) or extended (e:) data format')
+
+  if 'chco' in query and patterns['chco'].match(str(query['chco'])) is None:
+    messages.append('"chco" must be a list of RRGGBB or RRGGBBAA colors')
+
+  if 'chf' in query and not all(patterns['chf'].match(fill) for fill in str(query['chf']).split('|')):
+    messages.append('"chf" must be a list of <fill_type>,s,<color> or <fill_type>,lg,<angle>,<color>,<offset>,... fills')
+
+  if 'icac' in query and 'ichm' not in query and not secret:
+    messages.append('"icac" requires the "secret" option to compute the HMAC-SHA256 request signature (ichm)')
+
+  return messages
+
+def create_session(pool_connections=10, pool_maxsize=10):
+  """Create a keep-alive requests.Session suitable to be shared between charts
+
+  Retries are handled by the charts themselves, see the max_retries and backoff_factor options.
+
+  - pool_connections :int - number of per-host connection pools to keep
+  - pool_maxsize :int - maximum number of connections kept alive per host
+  """
+  import requests
+  from requests.adapters import HTTPAdapter
+
+  adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+def _get_default_session():
+  global _default_session
+  if _default_session is None:
+    with _default_session_lock:
+      if _default_session is None:
+        _default_session = create_session()
+  return _default_session
+
+class RequestsTransport:
+  """Transport downloading charts with a pooled keep-alive requests.Session (HTTP/1.1)
+
+  A transport is any object with a get(url, headers, timeout, stream=False) method returning a response with
+  status_code, headers, content, iter_content(chunk_size), close() and context manager support, and raising
+  ImageChartsTimeoutError or ImageChartsConnectionError when no response is received. Charts whose url exceeds
+  the post_threshold option are sent with post(url, headers, body, timeout, stream=False) when the transport has one.
+
+  - session :requests.Session - session to use, defaults to the keep-alive session shared by every chart
+  """
+
+  def __init__(self, session=None) -> None:
+    self.session = session
+
+  def get(self, url, headers, timeout, stream=False):
+    """GET url, timeout is a (connect, read) tuple in seconds"""
+    return self._send('get', url, headers, timeout, stream)
+
+  def post(self, url, headers, body, timeout, stream=False):
+    """POST body (bytes) to url, timeout is a (connect, read) tuple in seconds"""
+    return self._send('post', url, headers, timeout, stream, data=body)
+
+  def _send(self, method, url, headers, timeout, stream, **kwargs):
+    import requests
+
+    session = self.session if self.session is not None else _get_default_session()
+    try:
+      return getattr(session, method)(url, timeout=timeout, headers=headers, stream=stream, **kwargs)
+    except requests.Timeout as error:
+      raise ImageChartsTimeoutError(message=str(error)) from error
+    except requests.ConnectionError as error:
+      raise ImageChartsConnectionError(message=str(error)) from error
+
+  def close(self):
+    if self.session is not None:
+      self.session.close()
+
+_default_transport = RequestsTransport()
+
+class HTTP2Transport:
+  """Transport multiplexing concurrent chart downloads over one HTTP/2 connection per host (requires httpx[http2])
+
+  Thread-safe: render_many() workers, or threads sharing a chart, send their requests as streams of the same connection.
+  Plain http:// urls (like on-premise or local servers) fall back to HTTP/1.1.
+
+  - max_connections :int - maximum number of connections
+  - client :httpx.Client - client to use instead of a new HTTP/2 one
+  """
+
+  def __init__(self, max_connections=10, client=None) -> None:
+    import httpx
+    self.max_connections = max_connections if client is None else None
+    self.client = client if client is not None else httpx.Client(http2=True, limits=httpx.Limits(max_connections=max_connections))
+
+  def __reduce__(self):
+    # processes unpickling the transport open their own connections
+    if self.max_connections is None:
+      raise TypeError('cannot pickle an HTTP2Transport using a custom client')
+    return (HTTP2Transport, (self.max_connections,))
+
+  def get(self, url, headers, timeout, stream=False):
+    """GET url, timeout is a (connect, read) tuple in seconds"""
+    return self._send('GET', url, headers, timeout, stream)
+
+  def post(self, url, headers, body, timeout, stream=False):
+    """POST body (bytes) to url, timeout is a (connect, read) tuple in seconds"""
+    return self._send('POST', url, headers, timeout, stream, content=body)
+
+  def _send(self, method, url, headers, timeout, stream, **kwargs):
+    import httpx
+
+    connect, read = timeout
+    request = self.client.build_request(method, url, headers=headers, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+    sent_at = time.perf_counter()
+    try:
+      response = self.client.send(request, stream=True)
+      ttfb = time.perf_counter() - sent_at
+      if not stream:
+        try:
+          response.read()
+        finally:
+          response.close()
+    except httpx.TimeoutException as error:
+      raise ImageChartsTimeoutError(message=str(error) or 'request timed out') from error
+    except httpx.TransportError as error:
+      raise ImageChartsConnectionError(message=str(error)) from error
+    return _HTTPXResponse(response, ttfb)
+
+  def close(self):
+    self.client.close()
+
+class _HTTPXResponse:
+  """httpx.Response exposed like a requests.Response"""
+
+  def __init__(self, response, ttfb) -> None:
+    from datetime import timedelta
+
+    self._response = response
+    self.status_code = response.status_code
+    self.headers = response.headers
+    # like requests, the time until the response headers were received
+    self.elapsed = timedelta(seconds=ttfb)
+
+  @property
+  def content(self):
+    return self._response.content
+
+  def iter_content(self, chunk_size=1):
+    return self._response.iter_bytes(chunk_size)
+
+  def close(self):
+    self._response.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def create_async_session(limit=100, limit_per_host=0):
+  """Create an aiohttp.ClientSession to share between charts rendered with the *_async methods
+
+  Must be called from a running event loop, the caller is responsible for closing it. aiohttp sessions are bound to
+  their event loop, so there is no default shared session: the *_async methods only reuse connections through the
+  async_session option.
+
+  - limit :int - maximum number of simultaneous connections
+  - limit_per_host :int - maximum number of simultaneous connections per host (0 means no limit)
+  """
+  import aiohttp
+  return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host), trace_configs=[_trace_config()])
+
+class RateLimiter:
+  """Thread-safe token bucket allowing `rate` requests per second with bursts of up to `burst` requests"""
+
+  def __init__(self, rate, burst=1) -> None:
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self._tokens = float(burst)
+    self._updated_at = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """Block until a request is allowed"""
+    wait = self._reserve()
+    while wait > 0:
+      time.sleep(wait)
+      wait = self._reserve()
+
+  async def acquire_async(self):
+    """Wait, without blocking the event loop, until a request is allowed"""
+    import asyncio
+
+    wait = self._reserve()
+    while wait > 0:
+      await asyncio.sleep(wait)
+      wait = self._reserve()
+
+  def _reserve(self):
+    # take a token and return 0, or return how long to wait for the next one
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+      self._updated_at = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return 0
+      return (1 - self._tokens) / self.rate
+
+class FileRateLimiter(RateLimiter):
+  """Token bucket shared by every process using the same state file (POSIX only, relies on fcntl.flock)
+
+  - path :str - state file, created if missing
+  """
+
+  def __init__(self, path, rate, burst=1) -> None:
+    super().__init__(rate, burst)
+    self.path = path
+
+  def __reduce__(self):
+    # the state lives in the file, so processes unpickling the limiter keep sharing it
+    return (FileRateLimiter, (self.path, self.rate, self.burst))
+
+  def _reserve(self):
+    import fcntl
+    with self._lock, open(self.path, 'a+') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        f.seek(0)
+        state = f.read().split()
+        now = time.time()
+        tokens, updated_at = (float(state[0]), float(state[1])) if len(state) == 2 else (self.burst, now)
+        tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        if tokens >= 1:
+          tokens -= 1
+        f.seek(0)
+        f.truncate()
+        f.write('{tokens} {now}'.format(tokens=tokens, now=now))
+        return wait
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+class SingleFlight:
+  """Coalesce concurrent calls sharing a key: the first caller runs the call, the others wait for its outcome
+
+  Callers get the same result or the same exception. Works across threads (do) and across the tasks of
+  an event loop (do_async).
+  """
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()
+    self._calls = {}
+    self._tasks = {}
+
+  def do(self, key, fn):
+    """Return fn(), or the outcome of the in-flight call for key"""
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+
+    if not leader:
+      call['event'].wait()
+      if call['error'] is not None:
+        raise call['error']
+      return call['result']
+
+    try:
+      call['result'] = fn()
+      return call['result']
+    except BaseException as error:
+      call['error'] = error
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call['event'].set()
+
+  async def do_async(self, key, fn):
+    """Return await fn(), or the outcome of the in-flight call for key in the current event loop
+
+    fn() runs in a task of its own, a caller being cancelled does not cancel the call the others wait for.
+    """
+    import asyncio
+
+    # get_running_loop() is Python 3.7+
+    loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+    key = (loop, key)
+    task = self._tasks.get(key)
+    if task is None:
+      task = self._tasks[key] = loop.create_task(fn())
+      task.add_done_callback(lambda task: self._done_async(key, task))
+    return await asyncio.shield(task)
+
+  def _done_async(self, key, task):
+    del self._tasks[key]
+    # mark the exception as retrieved when every caller was cancelled
+    if not task.cancelled():
+      task.exception()
+
+_default_single_flight = SingleFlight()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _retry_delay(attempt, retry_after, backoff_factor, max_backoff):
+  """Seconds to wait before retrying: the Retry-After header when present, a full jitter exponential backoff otherwise"""
+  import random
+
+  if retry_after:
+    try:
+      return min(max_backoff, max(0.0, float(retry_after)))
+    except ValueError:
+      from email.utils import parsedate_to_datetime
+      try:
+        return min(max_backoff, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+      except (TypeError, ValueError):
+        pass
+  return random.uniform(0, min(max_backoff, backoff_factor * (2 ** attempt)))
+
+def _call_deadline(config, deadline=None):
+  """time.monotonic() deadline of a call: the earliest of the deadline option (from now) and deadline"""
+  if config.deadline is None:
+    return deadline
+  own = time.monotonic() + config.deadline / 1000.0
+  return own if deadline is None else min(own, deadline)
+
+def _attempt_timeouts(config, deadline):
+  """(connect, read) timeouts in seconds of the next attempt, capped to the time left before deadline"""
+  connect, read = config.connect_timeout / 1000.0, config.read_timeout / 1000.0
+  if deadline is None:
+    return connect, read
+  remaining = deadline - time.monotonic()
+  if remaining <= 0:
+    raise ImageChartsTimeoutError(message='deadline exceeded')
+  return min(connect, remaining), min(read, remaining)
+
+def _next_retry_delay(config, attempt, retry_after, deadline):
+  """Seconds to wait before the next attempt, None when the call must not be retried"""
+  if attempt >= config.max_retries:
+    return None
+  delay = _retry_delay(attempt, retry_after, config.backoff_factor, config.max_backoff)
+  if deadline is not None and time.monotonic() + delay >= deadline:
+    return None
+  return delay
+
+TIMINGS = ('dns', 'connect', 'tls', 'ttfb', 'download', 'total')
+
+def _request_event(url, query, method='GET'):
+  """Event passed to hooks, timings are in seconds and None when the transport does not expose them"""
+  return {'url': url, 'method': method, 'cht': query.get('cht'), 'status_code': None, 'bytes': 0, 'cache': None, 'retries': 0,
+    'timings': dict.fromkeys(TIMINGS), 'error': None}
+
+def _notify(hooks, name, event):
+  for hook in hooks:
+    callback = getattr(hook, name, None)
+    if callback is not None:
+      try:
+        callback(event)
+      except Exception:
+        # hooks observe renders, a failing hook is logged and does not change their outcome
+        import logging
+        logging.getLogger('ImageCharts').exception('{name} hook {hook!r} failed'.format(name=name, hook=hook))
+
+def _complete_event(hooks, event, started, error=None):
+  # report the outcome of a request to the after_response or on_error hooks
+  event['timings']['total'] = time.perf_counter() - started
+  if error is not None:
+    event['error'] = error
+    if isinstance(error, ImageChartsError) and error.status_code is not None:
+      event['status_code'] = error.status_code
+    _notify(hooks, 'on_error', event)
+  else:
+    _notify(hooks, 'after_response', event)
+
+def _trace_config():
+  """aiohttp.TraceConfig recording DNS resolution and connection times in the timings dict given as trace_request_ctx"""
+  import aiohttp
+
+  def start(name):
+    async def on_start(session, context, params):
+      setattr(context, name, time.perf_counter())
+    return on_start
+
+  def end(name):
+    async def on_end(session, context, params):
+      if isinstance(context.trace_request_ctx, dict) and hasattr(context, name):
+        context.trace_request_ctx[name] = time.perf_counter() - getattr(context, name)
+    return on_end
+
+  trace = aiohttp.TraceConfig()
+  trace.on_dns_resolvehost_start.append(start('dns'))
+  trace.on_dns_resolvehost_end.append(end('dns'))
+  # aiohttp reports the TLS handshake as part of the connection
+  trace.on_connection_create_start.append(start('connect'))
+  trace.on_connection_create_end.append(end('connect'))
+  return trace
+
+class MetricsAggregator:
+  """Hook aggregating request metrics per chart type (cht), thread-safe
+
+  Pass it in the 'hooks' option and export snapshot() to your metrics system.
+
+  - buckets :tuple - upper bounds (in seconds) of the latency histogram buckets
+  """
+
+  DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+  def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+    self.buckets = tuple(sorted(buckets))
+    self._lock = threading.Lock()
+    self._charts = {}
+
+  def _record(self, event):
+    with self._lock:
+      metrics = self._charts.get(event['cht'])
+      if metrics is None:
+        metrics = self._charts[event['cht']] = {'requests': 0, 'errors': {}, 'bytes': 0, 'retries': 0,
+          'cache': {'hit': 0, 'miss': 0, 'revalidated': 0}, 'latency': {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}}
+      metrics['requests'] += 1
+      metrics['bytes'] += event['bytes']
+      metrics['retries'] += event['retries']
+      if event['cache'] is not None:
+        metrics['cache'][event['cache']] += 1
+      if event['error'] is not None:
+        code = getattr(event['error'], 'error_code', None) or type(event['error']).__name__
+        metrics['errors'][code] = metrics['errors'].get(code, 0) + 1
+      total = event['timings']['total']
+      latency = metrics['latency']
+      latency['count'] += 1
+      latency['sum'] += total
+      # the last bucket counts the requests slower than every bound
+      latency['buckets'][next((index for index, bound in enumerate(self.buckets) if total <= bound), len(self.buckets))] += 1
+
+  after_response = _record
+  on_error = _record
+
+  def snapshot(self):
+    """Return a copy of the metrics: {cht: {requests, errors, bytes, retries, cache, latency: {count, sum, buckets}}}"""
+    import copy
+
+    with self._lock:
+      return copy.deepcopy(self._charts)
+
+  def reset(self):
+    with self._lock:
+      self._charts = {}
+
+CacheEntry = namedtuple('CacheEntry', ['content', 'etag', 'last_modified', 'stored_at', 'expires_at'])
+
+def _cache_entry(content, headers, now):
+  """Build a CacheEntry from response headers, return None if the response must not be stored"""
+  cache_control = headers.get('cache-control', '').lower()
+  directives = [directive.strip() for directive in cache_control.split(',')]
+  if 'no-store' in directives:
+    return None
+
+  expires_at = None
+  if 'no-cache' in directives:
+    expires_at = now
+  else:
+    for directive in directives:
+      if directive.startswith('max-age='):
+        try:
+          expires_at = now + int(directive[len('max-age='):])
+        except ValueError:
+          pass
+
+  return CacheEntry(content, headers.get('etag'), headers.get('last-modified'), now, expires_at)
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+class ChartCache:
+  """Thread-safe two-tier cache of rendered charts keyed by their (signed) url
+
+  Entries keep the ETag / Last-Modified validators of the response so stale charts are revalidated
+  with a conditional request. Cache-Control max-age defines how long an entry is served without any request.
+
+  - memory_bytes :int - byte budget of the in-memory LRU tier (0 disables it)
+  - directory :str - directory of the on-disk tier (None disables it), other files of the directory are left alone
+  - disk_bytes :int - byte budget of the on-disk tier, least recently written files are evicted first (None means no limit)
+  - ttl :float - time to live of cached charts in seconds (None means no expiration), entries without max-age are fresh until then
+  """
+
+  def __init__(self, memory_bytes=64 * 1024 * 1024, directory=None, disk_bytes=None, ttl=None) -> None:
+    self.memory_bytes = memory_bytes
+    self.directory = directory
+    self.disk_bytes = disk_bytes
+    self.ttl = ttl
+    self.hits = 0
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.revalidations = 0
+    self._memory = OrderedDict()
+    self._memory_size = 0
+    self._disk_size = 0
+    self._lock = threading.Lock()
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+      self._disk_size = sum(entry.stat().st_size for entry in self._disk_entries())
+
+  def __reduce__(self):
+    # an empty memory tier in the process unpickling the cache, the disk tier is shared
+    return (ChartCache, (self.memory_bytes, self.directory, self.disk_bytes, self.ttl))
+
+  def stats(self):
+    """Return hit/miss counters and current tier sizes as a dict"""
+    return {
+      'hits': self.hits,
+      'memory_hits': self.memory_hits,
+      'disk_hits': self.disk_hits,
+      'misses': self.misses,
+      'revalidations': self.revalidations,
+      'memory_bytes': self._memory_size,
+      'disk_bytes': self._disk_size
+    }
+
+  def get(self, key):
+    """Return fresh cached bytes for key or None"""
+    entry = self.lookup(key)
+    return entry.content if entry is not None and self.is_fresh(entry) else None
+
+  def lookup(self, key):
+    """Return the CacheEntry stored for key, fresh or stale (to be revalidated), or None
+
+    Fresh entries count as hits, stale and missing ones as misses.
+    """
+    now = time.time()
+    with self._lock:
+      entry = self._memory.get(key)
+      if entry is not None and not self._is_expired(entry, now):
+        self._memory.move_to_end(key)
+        return self._count(entry, now, memory=True)
+      if entry is not None:
+        self._memory_discard(key)
+
+    entry = self._disk_get(key, now)
+    if entry is not None:
+      self._memory_set(key, entry)
+    with self._lock:
+      return self._count(entry, now, memory=False)
+
+  def set(self, key, content, headers=None):
+    """Store chart bytes for key in every tier, along with the validators of the response headers"""
+    entry = _cache_entry(content, headers if headers is not None else {}, time.time())
+    if entry is not None:
+      self._memory_set(key, entry)
+      self._disk_set(key, entry)
+
+  def revalidated(self, key, entry, headers):
+    """Refresh a stale entry after a 304 Not Modified response and return its content"""
+    with self._lock:
+      self.revalidations += 1
+    merged = {'etag': entry.etag, 'last-modified': entry.last_modified}
+    merged.update({name.lower(): value for name, value in headers.items()})
+    self.set(key, entry.content, {name: value for name, value in merged.items() if value is not None})
+    return entry.content
+
+  def is_fresh(self, entry, now=None):
+    """Whether entry can be served without contacting the API"""
+    now = time.time() if now is None else now
+    if entry.expires_at is not None:
+      return now < entry.expires_at
+    return not self._is_expired(entry, now)
+
+  def clear(self):
+    """Remove every cached chart"""
+    with self._lock:
+      self._memory.clear()
+      self._memory_size = 0
+      if self.directory is not None:
+        for entry in self._disk_entries():
+          os.remove(entry.path)
+        self._disk_size = 0
+
+  def _count(self, entry, now, memory):
+    if entry is None or not self.is_fresh(entry, now):
+      self.misses += 1
+    else:
+      self.hits += 1
+      if memory:
+        self.memory_hits += 1
+      else:
+        self.disk_hits += 1
+    return entry
+
+  def _is_expired(self, entry, now):
+    return self.ttl is not None and now - entry.stored_at >= self.ttl
+
+  def _memory_discard(self, key):
+    entry = self._memory.pop(key)
+    self._memory_size -= len(entry.content)
+
+  def _memory_set(self, key, entry):
+    if len(entry.content) > self.memory_bytes:
+      return
+    with self._lock:
+      if key in self._memory:
+        self._memory_discard(key)
+      self._memory[key] = entry
+      self._memory_size += len(entry.content)
+      while self._memory_size > self.memory_bytes:
+        self._memory_discard(next(iter(self._memory)))
+
+  def _disk_path(self, key):
+    import hashlib
+    return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+  def _disk_entries(self):
+    # the directory may hold other files, only the sha256 named entries written by the cache are counted and evicted
+    return [entry for entry in os.scandir(self.directory) if len(entry.name) == 64 and _HEX_DIGITS.issuperset(entry.name) and entry.is_file()]
+
+  def _disk_get(self, key, now):
+    # disk entries are a JSON line of metadata followed by the chart bytes
+    if self.directory is None:
+      return None
+    import json
+    try:
+      with open(self._disk_path(key), 'rb') as f:
+        metadata = json.loads(f.readline().decode('utf-8'))
+        entry = CacheEntry(f.read(), metadata['etag'], metadata['last_modified'], metadata['stored_at'], metadata['expires_at'])
+    except (OSError, ValueError, KeyError):
+      return None
+    return None if self._is_expired(entry, now) else entry
+
+  def _disk_set(self, key, entry):
+    if self.directory is None:
+      return
+    import json, tempfile
+
+    path = self._disk_path(key)
+    metadata = json.dumps({
+      'etag': entry.etag,
+      'last_modified': entry.last_modified,
+      'stored_at': entry.stored_at,
+      'expires_at': entry.expires_at
+    }).encode('utf-8') + b'\n'
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(metadata)
+      f.write(entry.content)
+    with self._lock:
+      try:
+        self._disk_size -= os.path.getsize(path)
+      except OSError:
+        pass
+      os.replace(tmp_path, path)
+      self._disk_size += len(metadata) + len(entry.content)
+      if self.disk_bytes is not None and self._disk_size > self.disk_bytes:
+        self._disk_evict()
+
+  def _disk_evict(self):
+    entries = sorted(self._disk_entries(), key=lambda entry: entry.stat().st_mtime)
+    for entry in entries:
+      if self._disk_size <= self.disk_bytes:
+        break
+      try:
+        size = entry.stat().st_size
+        os.remove(entry.path)
+        self._disk_size -= size
+      except OSError:
+        pass
+
+BatchResult = namedtuple('BatchResult', ['index', 'chart', 'content', 'error'])
+
+ChartTimings = namedtuple('ChartTimings', TIMINGS)
+
+class ChartResponse(namedtuple('ChartResponse', ['content', 'mimetype', 'status_code', 'headers', 'request_headers', 'cache', 'retries', 'timings'])):
+  """Immutable outcome of ImageCharts.render()
+
+  - content :bytes|iterator - the chart image, or an iterator of chunks of bytes when streamed
+  - mimetype :str - image/png or image/gif
+  - status_code :int - HTTP status code of the response, None when served from the cache
+  - headers :mapping - read-only response headers (empty when served from the cache)
+  - request_headers :mapping - read-only request headers
+  - cache :str - 'hit', 'miss', 'revalidated' or None without cache
+  - retries :int - number of retried attempts
+  - timings :ChartTimings - dns, connect, tls, ttfb, download and total durations in seconds (None when unknown)
+  """
+
+  __slots__ = ()
+
+  def to_data_uri(self) -> str:
+    """base64 encoded data URI of a buffered (not streamed) response"""
+    return _data_uri(self.mimetype, self.content)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_SESSION_OPTIONS = ('pool_connections', 'pool_maxsize')
+
+# longest url sent with GET by default, most servers and proxies reject request lines above 8KB
+DEFAULT_POST_THRESHOLD = 8000
+
+_POST_CONTENT_TYPES = {'form': 'application/x-www-form-urlencoded', 'json': 'application/json'}
+
+# a chart download: key identifies the chart for the cache and coalescing (its signed GET url),
+# body is None for GET requests
+_ChartRequest = namedtuple('_ChartRequest', ['key', 'url', 'body', 'content_type'])
+
+class _Signer:
+  """Thread-safe HMAC-SHA256 signer of query strings
+
+  The secret is hashed once into a keyed state, copied for each signature, and the signatures of the
+  last `size` query strings, holding at most `max_bytes` characters in total, are memoized (charts are
+  commonly signed more than once: to_url, then render).
+  """
+
+  def __init__(self, secret, size=1024, max_bytes=1024 * 1024) -> None:
+    import hmac, hashlib
+
+    self.key_state = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+    self.size = size
+    self.max_bytes = max_bytes
+    self._signatures = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+  def sign(self, query_string):
+    with self._lock:
+      signature = self._signatures.get(query_string)
+      if signature is not None:
+        self._signatures.move_to_end(query_string)
+        return signature
+
+    state = self.key_state.copy()
+    state.update(query_string.encode('utf-8'))
+    signature = state.hexdigest()
+
+    if self.size > 0 and len(query_string) <= self.max_bytes:
+      with self._lock:
+        if query_string not in self._signatures:
+          self._signatures[query_string] = signature
+          self._bytes += len(query_string)
+        while len(self._signatures) > self.size or self._bytes > self.max_bytes:
+          self._bytes -= len(self._signatures.popitem(last=False)[0])
+    return signature
+
+class _Config:
+  """Options of a chart, shared by reference between a chart and every chart derived from it"""
+
+  __slots__ = ('options', 'handle', '__weakref__', 'protocol', 'host', 'port', 'pathname', 'timeout', 'connect_timeout', 'read_timeout', 'deadline', 'secret', 'user_agent',
+    'session', 'transport', 'async_session', 'cache', 'post_threshold', 'post_format',
+    'max_retries', 'backoff_factor', 'max_backoff', 'rate_limiter', 'single_flight', 'validate', 'hooks', 'signer')
+
+  def __init__(self, options) -> None:
+    self.options = options
+    self.handle = None
+    self.protocol = options['protocol'] if 'protocol' in options else 'https'
+    self.host = options['host']  if 'host' in options else 'image-charts.com'
+    self.port = options['port']  if 'port' in options else  443
+    self.pathname = options['pathname']  if 'pathname' in options else '/chart'
+    self.timeout = options['timeout']  if 'timeout' in options else 5000
+    self.connect_timeout = options['connect_timeout'] if 'connect_timeout' in options else self.timeout
+    self.read_timeout = options['read_timeout'] if 'read_timeout' in options else self.timeout
+    self.deadline = options['deadline'] if 'deadline' in options else None
+    self.secret = options['secret']  if 'secret' in options else None
+    signature_cache_size = options['signature_cache_size'] if 'signature_cache_size' in options else 1024
+    self.signer = _Signer(self.secret, signature_cache_size) if self.secret and len(self.secret) > 0 else None
+    self.user_agent = options['user_agent'] if 'user_agent' in options else None
+    self.session = options['session'] if 'session' in options else None
+    if self.session is None and any(key in options for key in _SESSION_OPTIONS):
+      self.session = create_session(**{key: options[key] for key in _SESSION_OPTIONS if key in options})
+    self.transport = options['transport'] if 'transport' in options else None
+    if self.transport is None and self.session is not None:
+      self.transport = RequestsTransport(self.session)
+    self.async_session = options['async_session'] if 'async_session' in options else None
+    self.post_threshold = options['post_threshold'] if 'post_threshold' in options else DEFAULT_POST_THRESHOLD
+    self.post_format = options['post_format'] if 'post_format' in options else 'form'
+    if self.post_format not in _POST_CONTENT_TYPES:
+      raise ValueError('unknown post_format "{post_format}", expected form or json'.format(post_format=self.post_format))
+    self.cache = options['cache'] if 'cache' in options else None
+    self.max_retries = options['max_retries'] if 'max_retries' in options else 0
+    self.backoff_factor = options['backoff_factor'] if 'backoff_factor' in options else 0.5
+    self.max_backoff = options['max_backoff'] if 'max_backoff' in options else 30
+    self.rate_limiter = options['rate_limiter'] if 'rate_limiter' in options else None
+    self.validate = options['validate'] if 'validate' in options else False
+    self.hooks = tuple(options['hooks']) if 'hooks' in options else ()
+    coalesce = options['coalesce'] if 'coalesce' in options else False
+    self.single_flight = coalesce if isinstance(coalesce, SingleFlight) else (_default_single_flight if coalesce else None)
+
+# version of the pickled form of charts and config handles
+WIRE_VERSION = 1
+
+# maximum number of configs rebuilt from handles pickled by other processes
+WIRE_CONFIGS_SIZE = 64
+
+# configs of the handles created in this process, and configs rebuilt from handles pickled by other processes
+# (keyed by the contents of their options, so every chart unpickled with equal options reuses their session, cache
+# and signer, the least recently used ones are dropped beyond WIRE_CONFIGS_SIZE)
+_local_configs = weakref.WeakValueDictionary()
+_wire_configs = OrderedDict()
+_configs_lock = threading.Lock()
+
+class ConfigHandle:
+  """Picklable reference to the options of a chart, every chart created from a handle in a process shares them
+
+  Unpickled in another process, a handle rebuilds the options once from their picklable part: options that cannot
+  be pickled (hooks, sessions, in-process rate limiters...) fall back to their defaults there.
+
+  - token :str - identifier of the options
+  - options :dict - picklable options
+  """
+
+  __slots__ = ('token', 'options')
+
+  def __init__(self, token, options) -> None:
+    self.token = token
+    self.options = options
+
+  def __reduce__(self):
+    return (_handle_from_wire, (WIRE_VERSION, self.token, self.options))
+
+  def _config(self):
+    config = _local_configs.get(self.token)
+    if config is not None:
+      return config
+    import pickle
+    key = pickle.dumps(self.options)
+    with _configs_lock:
+      config = _wire_configs.get(key)
+      if config is not None:
+        _wire_configs.move_to_end(key)
+        return config
+      config = _Config(self.options)
+      config.handle = self
+      _wire_configs[key] = config
+      if len(_wire_configs) > WIRE_CONFIGS_SIZE:
+        _wire_configs.popitem(last=False)
+    return config
+
+def _config_handle(config):
+  if config.handle is None:
+    with _configs_lock:
+      if config.handle is None:
+        handle = ConfigHandle(os.urandom(8).hex(), {key: value for key, value in config.options.items() if _is_picklable(value)})
+        _local_configs[handle.token] = config
+        config.handle = handle
+  return config.handle
+
+def _is_picklable(value):
+  if value is None or isinstance(value, (str, int, float, bool)):
+    return True
+  import pickle
+  try:
+    pickle.dumps(value)
+  except Exception:
+    return False
+  return True
+
+def _check_wire_version(version):
+  if version != WIRE_VERSION:
+    raise ValueError('unsupported ImageCharts wire format version {version}, expected {expected}'.format(version=version, expected=WIRE_VERSION))
+
+def _handle_from_wire(version, token, options):
+  _check_wire_version(version)
+  return ConfigHandle(token, options)
+
+def _chart_from_wire(version, handle, params):
+  _check_wire_version(version)
+  return ImageCharts(handle, dict(params))
+
+# guards the materialization of the query of charts, which drops their link to their parent
+_query_lock = threading.Lock()
+
+def _config_property(name):
+  return property(lambda self: getattr(self._config, name))
 
 class ImageCharts:
   """A python client for image-charts.com, a web service that generates static charts."""
 
+  # a chart only stores the parameter it adds and a link to the chart it was derived from,
+  # the query dict is materialized on first access
+  __slots__ = ('_config', '_parent', '_param', '_value', '_query', 'request_headers', 'response_headers')
+
+  protocol = _config_property('protocol')
+  host = _config_property('host')
+  port = _config_property('port')
+  pathname = _config_property('pathname')
+  timeout = _config_property('timeout')
+  secret = _config_property('secret')
+  user_agent = _config_property('user_agent')
+  session = _config_property('session')
+  transport = _config_property('transport')
+  async_session = _config_property('async_session')
+
   def __init__(self, options=None, previous=None) -> None:
-    """Image-Charts constructor"""
+    """Image-Charts constructor
+
+    - options :dict|ConfigHandle - options, or the handle of the options of another chart to share them
+    """
 
     if previous is None:
       previous = {}
     if options is None:
       options = {}
 
-    self.protocol = options['protocol'] if 'protocol' in options else 'https'
-    self.host = options['host']  if 'host' in options else 'image-charts.com'
-    self.port = options['port']  if 'port' in options else  443
-    self.pathname = options['pathname']  if 'pathname' in options else '/chart'
-    self.timeout = options['timeout']  if 'timeout' in options else 5000
-    self.secret = options['secret']  if 'secret' in options else None
-    self.user_agent = options['user_agent'] if 'user_agent' in options else None
-    self.query = previous
+    self._config = options._config() if isinstance(options, ConfigHandle) else _Config(options)
+    self._parent = None
+    self._param = None
+    self._value = None
+    self._query = previous
     self.request_headers = {}
     self.response_headers = {}
 
+  @property
+  def query(self):
+    if self._query is None:
+      with _query_lock:
+        if self._query is None:
+          chain = []
+          node = self
+          while node._query is None:
+            chain.append(node)
+            node = node._parent
+          query = dict(node._query)
+          for node in reversed(chain):
+            query[node._param] = node._value
+          self._query = query
+          # the query holds everything the chain was needed for, let the parent charts be freed
+          self._parent = self._param = self._value = None
+    return self._query
+
+  @property
+  def handle(self):
+    """ConfigHandle of the options of this chart, to create charts sharing them in this process or in worker processes"""
+    return _config_handle(self._config)
+
+  def __reduce__(self):
+    # a chart is pickled as the handle of its options and its parameter pairs, headers are not sent
+    return (_chart_from_wire, (WIRE_VERSION, _config_handle(self._config), tuple(self.query.items())))
+
   def __clone(self, param: str, value :str):
-    add = {}
-    add[param] = value
-    return ImageCharts({
-      'protocol' : self.protocol,
-      'host' : self.host,
-      'port' : self.port,
-      'pathname' : self.pathname,
-      'timeout' : self.timeout,
-      'secret' : self.secret,
-      'user_agent' : self.user_agent
-    }, {**self.query, **add})
+    chart = ImageCharts.__new__(ImageCharts)
+    chart._config = self._config
+    chart._parent = self
+    chart._param = param
+    chart._value = value
+    chart._query = None
+    chart.request_headers = {}
+    chart.response_headers = {}
+    return chart
 
 
   
@@ -548,58 +1615,586 @@ class ImageCharts:
 
   
 
+  def validate(self):
+    """Check the chart parameters locally, raise an ImageChartsValidationError listing every problem found"""
+    messages = validate_query(self.query, self.secret)
+    if messages:
+      raise ImageChartsValidationError(error_code='IC_LOCAL_VALIDATION', validation_messages=messages)
+
   def to_url(self) -> str:
     """Get the full Image-Charts API url (signed and encoded if necessary)"""
+    query_string, signature = self._query_string()
+    url = self._endpoint() + '?' + query_string
+    if signature is not None:
+      url += '&ichm=' + signature
+    return url
 
-    def sign(query, secretKey):
-      return codecs.getencoder('hex')(hmac.new(secretKey.encode('utf-8'), query.encode('utf-8'), hashlib.sha256).digest())[0].decode('utf-8')
-
-    query_string = "&".join( [ param + '=' + (quote_plus(str(self.query[param]))) for param in self.query.keys() ] )
-    url = '{protocol}://{host}:{port}{pathname}?'.format(protocol=self.protocol, host=self.host, port=self.port, pathname=self.pathname) + query_string
+  def _endpoint(self):
+    return '{protocol}://{host}:{port}{pathname}'.format(protocol=self.protocol, host=self.host, port=self.port, pathname=self.pathname)
 
-    if 'icac' in self.query and self.secret and len(self.secret) > 0:
-      url += '&ichm=' + sign(query_string, self.secret)
+  def _query_string(self):
+    # encoded query string and its ichm signature (None when the chart is not signed)
+    if self._config.validate:
+      self.validate()
 
-    return url
+    query_string = "&".join( [ param + '=' + _quote(self.query[param]) for param in self.query.keys() ] )
+    signature = self._config.signer.sign(query_string) if 'icac' in self.query and self._config.signer is not None else None
+    return query_string, signature
 
-  def to_binary(self):
-    """Yield the content of the chart image as bytes (blocking)"""
+  def _chart_request(self, can_post=True):
+    """GET request of the chart, or POST request once its url is longer than the post_threshold option
 
+    The body holds the parameters signed like the url: a form body is the query string of the url, a JSON body
+    maps each parameter to its value, ichm included.
+    """
+    query_string, signature = self._query_string()
+    signed_query_string = query_string if signature is None else query_string + '&ichm=' + signature
+    endpoint = self._endpoint()
+    url = endpoint + '?' + signed_query_string
+    threshold = self._config.post_threshold
+    if not can_post or threshold is None or len(url) <= threshold:
+      return _ChartRequest(url, url, None, None)
+
+    if self._config.post_format == 'form':
+      body = signed_query_string.encode('ascii')
+    else:
+      import json
+      params = {param: str(value) for param, value in self.query.items()}
+      if signature is not None:
+        params['ichm'] = signature
+      body = json.dumps(params, separators=(',', ':')).encode('utf-8')
+    return _ChartRequest(url, endpoint, body, _POST_CONTENT_TYPES[self._config.post_format])
+
+  def to_urls(self, rows, processes=None, chunksize=1000):
+    """Yield the (signed) url of this chart extended with each row of parameters
+
+    - rows :iterable|dict - parameter dicts (one per chart) or columnar parameters as a dict of lists
+    - processes :int - number of worker processes, urls are generated in the current process when None
+    - chunksize :int - number of rows sent to a worker process at a time
+    """
+    if isinstance(rows, dict):
+      params = list(rows.keys())
+      rows = (dict(zip(params, values)) for values in zip(*rows.values()))
+
+    if not processes:
+      template = ChartTemplate(self)
+      for row in rows:
+        yield template.to_url(row)
+      return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    base = (self.handle, tuple(self.query.items()))
+    rows = iter(rows)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+      # keep a bounded number of chunks in flight so rows are consumed as a stream
+      pending = []
+      while True:
+        while len(pending) < processes * 2:
+          chunk = list(islice(rows, chunksize))
+          if not chunk:
+            break
+          pending.append(executor.submit(_template_urls, base, chunk))
+        if not pending:
+          return
+        for url in pending.pop(0).result():
+          yield url
+
+  def _default_request_headers(self):
     default_user_agent = 'python-image-charts/latest' + (' ({icac})'.format(icac=self.query['icac']) if 'icac' in self.query and len(self.query['icac']) > 0 else '')
-    self.request_headers = {'user-agent': self.user_agent if self.user_agent else default_user_agent}
-    response = requests.get(self.to_url(), timeout=self.timeout, headers=self.request_headers)
+    return {'user-agent': self.user_agent if self.user_agent else default_user_agent}
+
+  def _cache_lookup(self, request):
+    # request headers, conditional ones included when a stale entry can be revalidated
+    request_headers = self._default_request_headers()
+    if request.content_type is not None:
+      request_headers['content-type'] = request.content_type
+    if self._config.cache is None:
+      return None, request_headers
+    entry = self._config.cache.lookup(request.key)
+    if entry is not None and entry.etag:
+      request_headers['if-none-match'] = entry.etag
+    if entry is not None and entry.last_modified:
+      request_headers['if-modified-since'] = entry.last_modified
+    return entry, request_headers
+
+  def _cache_response(self, url, entry, status_code, headers, content):
+    if status_code == 304 and entry is not None:
+      return self._config.cache.revalidated(url, entry, headers)
+    content = _check_response(status_code, headers, content)
+    if self._config.cache is not None:
+      self._config.cache.set(url, content, headers)
+    return content
+
+  def _cache_status(self, entry, status_code):
+    if self._config.cache is None:
+      return None
+    return 'revalidated' if status_code == 304 and entry is not None else 'miss'
+
+  def _transport(self):
+    return self._config.transport if self._config.transport is not None else _default_transport
+
+  def _send(self, request, request_headers, event, stream=False, deadline=None):
+    # send request, retrying connection errors and RETRY_STATUSES responses up to max_retries times and until deadline
+    config = self._config
+    transport = self._transport()
+    attempt = 0
+    while True:
+      if config.rate_limiter is not None:
+        config.rate_limiter.acquire()
+      timeout = _attempt_timeouts(config, deadline)
+      sent_at = time.perf_counter()
+      try:
+        if request.body is None:
+          response = transport.get(request.url, request_headers, timeout, stream=stream)
+        else:
+          response = transport.post(request.url, request_headers, request.body, timeout, stream=stream)
+      except (ImageChartsTimeoutError, ImageChartsConnectionError):
+        delay = _next_retry_delay(config, attempt, None, deadline)
+        if delay is None:
+          raise
+      else:
+        # requests measures the time until the response headers are parsed, the body is read afterwards
+        elapsed = getattr(response, 'elapsed', None)
+        event['status_code'] = response.status_code
+        event['timings']['ttfb'] = elapsed.total_seconds() if elapsed is not None else None
+        if not stream:
+          event['timings']['download'] = max(0.0, time.perf_counter() - sent_at - (event['timings']['ttfb'] or 0.0))
+        if response.status_code not in RETRY_STATUSES:
+          return response
+        delay = _next_retry_delay(config, attempt, response.headers.get('retry-after'), deadline)
+        if delay is None:
+          return response
+        response.close()
+      time.sleep(delay)
+      attempt += 1
+      event['retries'] = attempt
+
+  def _mimetype(self):
+    return 'image/gif' if 'chan' in self.query else 'image/png'
+
+  def _chart_response(self, content, status_code, headers, request_headers, event, stream=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    content_type = headers.get('content-type', '')
+    return ChartResponse(
+      _chunks(content, chunk_size) if stream else content,
+      content_type if content_type.startswith('image/') else self._mimetype(),
+      status_code,
+      MappingProxyType(headers),
+      MappingProxyType(request_headers),
+      event['cache'],
+      event['retries'],
+      ChartTimings(**event['timings'])
+    )
+
+  def render(self, stream=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Download the chart and return a ChartResponse, without modifying the chart (blocking)
+
+    Unlike to_binary(), nothing is stored on the chart: a chart can be rendered from many threads at once.
+
+    - stream :bool - ChartResponse.content is an iterator of chunks of bytes instead of bytes, the image is not buffered
+      unless a cache is configured (timings.download and timings.total are then only reported to hooks)
+    - chunk_size :int - size of the streamed chunks
+    """
+    return self._render(stream=stream, chunk_size=chunk_size)
+
+  def _render(self, deadline=None, stream=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    started = time.perf_counter()
+    deadline = _call_deadline(self._config, deadline)
+    request = self._chart_request(hasattr(self._transport(), 'post'))
+    hooks = self._config.hooks
+    event = _request_event(request.url, self.query, 'GET' if request.body is None else 'POST')
+    entry, request_headers = self._cache_lookup(request)
+    if entry is not None and self._config.cache.is_fresh(entry):
+      event.update(cache='hit', bytes=len(entry.content))
+      _complete_event(hooks, event, started)
+      return self._chart_response(entry.content, None, {}, request_headers, event, stream, chunk_size)
+
+    if stream and self._config.cache is None:
+      _notify(hooks, 'before_request', event)
+      response = None
+      try:
+        response = self._send(request, request_headers, event, stream=True, deadline=deadline)
+        _check_response(response.status_code, response.headers, None)
+      except Exception as error:
+        if response is not None:
+          response.close()
+        _complete_event(hooks, event, started, error)
+        raise
+      chart_response = self._chart_response(b'', response.status_code, response.headers, request_headers, event)
+      return chart_response._replace(content=_stream_content(response, chunk_size, hooks, event, started, deadline))
+
+    def fetch():
+      _notify(hooks, 'before_request', event)
+      try:
+        response = self._send(request, request_headers, event, deadline=deadline)
+        event['bytes'] = len(response.content)
+        event['cache'] = self._cache_status(entry, response.status_code)
+        content = self._cache_response(request.key, entry, response.status_code, response.headers, response.content)
+      except Exception as error:
+        _complete_event(hooks, event, started, error)
+        raise
+      _complete_event(hooks, event, started)
+      return response.status_code, response.headers, content, event
+
+    # coalesced callers get the outcome (and timings) of the request they waited for
+    single_flight = self._config.single_flight
+    status_code, headers, content, outcome = single_flight.do(request.key, fetch) if single_flight is not None else fetch()
+    return self._chart_response(content, status_code, headers, request_headers, outcome, stream, chunk_size)
 
-    self.response_headers = response.headers;
+  def to_binary(self):
+    """Yield the content of the chart image as bytes (blocking)
 
-    if response.status_code >= 200 and response.status_code < 300:
-      return response.content
+    The headers of the request and of the response are kept in request_headers and response_headers, use render()
+    to share a chart between threads.
+    """
+    self.request_headers = self._default_request_headers()
+    response = self._render()
+    self.request_headers, self.response_headers = dict(response.request_headers), response.headers
+    return response.content
 
-    error_code = self.response_headers.get('x-ic-error-code', 'HTTP_{}'.format(response.status_code))
-    validation_message_raw = self.response_headers.get('x-ic-error-validation', '')
+  def to_data_uri(self) -> str:
+    """Do a blocking request to Image-Charts API with current configuration and a base64 encoded data URI
 
-    if not validation_message_raw or len(validation_message_raw) == 0:
-        raise Exception(error_code)
+    Return base64 data URI as str
+    """
+    return _data_uri(self._mimetype(), self.to_binary())
 
-    validation_message = json.loads(validation_message_raw)
+  def iter_binary(self, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the content of the chart image as chunks of bytes, without buffering the whole image (blocking)
 
-    if not validation_message or len(validation_message) < 1:
-      raise Exception(error_code)
+    Charts are buffered when a cache is configured, since they have to be stored anyway.
+    """
+    self.request_headers = self._default_request_headers()
+    response = self._render(stream=True, chunk_size=chunk_size)
+    self.request_headers, self.response_headers = dict(response.request_headers), response.headers
+    yield from response.content
 
-    raise Exception(validation_message[0]['message'])
+  def write_data_uri(self, fp, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream the base64 encoded data URI of the chart to the text file-like object fp (blocking)
 
-  def to_data_uri(self) -> str:
-    """Do a blocking request to Image-Charts API with current configuration and a base64 encoded data URI
+    Only about one chunk of the image is held in memory at a time.
+    """
+    from base64 import b64encode
+
+    fp.write('data:{mimetype};base64,'.format(mimetype=self._mimetype()))
+    pending = b''
+    for chunk in self.iter_binary(chunk_size):
+      pending += chunk
+      # base64 encodes 3 bytes at a time, keep the remainder for the next chunk
+      size = len(pending) - len(pending) % 3
+      fp.write(b64encode(pending[:size]).decode('ascii'))
+      pending = pending[size:]
+    fp.write(b64encode(pending).decode('ascii'))
+
+  def to_file(self, path, chunk_size=DEFAULT_CHUNK_SIZE) -> str:
+    """Do a blocking request to Image-Charts API with current configuration and write the chart image to path (blocking)
+
+    The image is streamed to a temporary file next to path then atomically renamed, path is never left half-written.
+    """
+    fd, tmp_path = _create_temporary_file(path)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        for chunk in self.iter_binary(chunk_size):
+          f.write(chunk)
+      os.replace(tmp_path, path)
+    except BaseException:
+      os.remove(tmp_path)
+      raise
+
+  @staticmethod
+  def render_many(charts, concurrency=8, ordered=True, rate_limit=None, deadline=None):
+    """Download many charts concurrently from a thread pool (blocking generator)
+
+    Yield one BatchResult(index, chart, content, error) per chart, errors are reported and do not abort the batch.
+
+    - charts :iterable - ImageCharts instances to render
+    - concurrency :int - maximum number of simultaneous downloads
+    - ordered :bool - yield results in input order (True) or as soon as they complete (False)
+    - rate_limit :float|RateLimiter - maximum number of requests per second shared by every worker
+    - deadline :int - time budget of the whole batch in milliseconds, charts not rendered in time are cancelled
+      and reported with an ImageChartsTimeoutError
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+
+    limiter = rate_limit if rate_limit is None or isinstance(rate_limit, RateLimiter) else RateLimiter(rate_limit)
+    batch_deadline = time.monotonic() + deadline / 1000.0 if deadline is not None else None
+
+    def render(index, chart):
+      try:
+        if limiter is not None:
+          limiter.acquire()
+        return BatchResult(index, chart, chart._render(batch_deadline).content, None)
+      except Exception as error:
+        return BatchResult(index, chart, None, error)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      submitted = [(executor.submit(render, index, chart), index, chart) for index, chart in enumerate(charts)]
+      futures = [future for future, index, chart in submitted]
+      if batch_deadline is None:
+        for future in (futures if ordered else as_completed(futures)):
+          yield future.result()
+        return
+
+      # in-flight renders give up by themselves at the deadline, queued ones are cancelled
+      def remaining():
+        return max(0.0, batch_deadline - time.monotonic())
+
+      def expire(done):
+        for future in futures:
+          future.cancel()
+        for future, index, chart in submitted:
+          if future in done:
+            continue
+          if future.done() and not future.cancelled():
+            yield future.result()
+          else:
+            yield BatchResult(index, chart, None, ImageChartsTimeoutError(message='batch deadline exceeded'))
+
+      done = set()
+      try:
+        for future in (futures if ordered else as_completed(futures, timeout=remaining())):
+          result = future.result(timeout=remaining())
+          done.add(future)
+          yield result
+      except FutureTimeoutError:
+        yield from expire(done)
+
+  async def render_async(self):
+    """Download the chart and return a ChartResponse, without modifying the chart (non-blocking, requires aiohttp)
+
+    Connections are only reused through the async_session option (see create_async_session()): without it, each
+    call opens and closes its own aiohttp session, so its own connection.
+    """
+    return await self._render_async()
+
+  async def _render_async(self, deadline=None):
+    started = time.perf_counter()
+    deadline = _call_deadline(self._config, deadline)
+    request = self._chart_request()
+    hooks = self._config.hooks
+    event = _request_event(request.url, self.query, 'GET' if request.body is None else 'POST')
+    entry, request_headers = self._cache_lookup(request)
+    if entry is not None and self._config.cache.is_fresh(entry):
+      event.update(cache='hit', bytes=len(entry.content))
+      _complete_event(hooks, event, started)
+      return self._chart_response(entry.content, None, {}, request_headers, event)
+
+    async def fetch():
+      _notify(hooks, 'before_request', event)
+      session = self.async_session if self.async_session is not None else create_async_session()
+      try:
+        status, headers, content = await self._send_async(session, request, request_headers, event, deadline)
+        event.update(bytes=len(content), cache=self._cache_status(entry, status))
+        content = self._cache_response(request.key, entry, status, headers, content)
+      except Exception as error:
+        _complete_event(hooks, event, started, error)
+        raise
+      finally:
+        if self.async_session is None:
+          await session.close()
+      _complete_event(hooks, event, started)
+      return status, headers, content, event
+
+    single_flight = self._config.single_flight
+    status, headers, content, outcome = await (single_flight.do_async(request.key, fetch) if single_flight is not None else fetch())
+    return self._chart_response(content, status, headers, request_headers, outcome)
+
+  async def to_binary_async(self):
+    """Yield the content of the chart image as bytes (non-blocking, requires aiohttp)
+
+    Connections are only reused through the async_session option, see render_async().
+    """
+    self.request_headers = self._default_request_headers()
+    response = await self._render_async()
+    self.request_headers, self.response_headers = dict(response.request_headers), response.headers
+    return response.content
+
+  async def _send_async(self, session, request, request_headers, event, deadline=None):
+    # same retry policy as _send, retried responses are released without reading their body
+    import asyncio, aiohttp
+
+    config = self._config
+    timings = event['timings']
+    attempt = 0
+    while True:
+      if config.rate_limiter is not None:
+        await config.rate_limiter.acquire_async()
+      connect, read = _attempt_timeouts(config, deadline)
+      # unlike requests, aiohttp can bound the whole attempt, body included
+      timeout = aiohttp.ClientTimeout(total=deadline - time.monotonic() if deadline is not None else None, sock_connect=connect, sock_read=read)
+      sent_at = time.perf_counter()
+      try:
+        method = 'GET' if request.body is None else 'POST'
+        async with session.request(method, request.url, data=request.body, timeout=timeout, headers=request_headers, trace_request_ctx=timings) as response:
+          event['status_code'] = response.status
+          timings['ttfb'] = time.perf_counter() - sent_at
+          delay = None
+          if response.status in RETRY_STATUSES:
+            delay = _next_retry_delay(config, attempt, response.headers.get('retry-after'), deadline)
+          if delay is None:
+            headers_at = time.perf_counter()
+            content = await response.read()
+            timings['download'] = time.perf_counter() - headers_at
+            return response.status, response.headers, content
+      except asyncio.TimeoutError as error:
+        delay = _next_retry_delay(config, attempt, None, deadline)
+        if delay is None:
+          raise ImageChartsTimeoutError(message=str(error) or 'request timed out') from error
+      except aiohttp.ClientError as error:
+        delay = _next_retry_delay(config, attempt, None, deadline)
+        if delay is None:
+          raise ImageChartsConnectionError(message=str(error)) from error
+      await asyncio.sleep(delay)
+      attempt += 1
+      event['retries'] = attempt
+
+  async def to_data_uri_async(self) -> str:
+    """Do a non-blocking request to Image-Charts API with current configuration and a base64 encoded data URI
+
+    Connections are only reused through the async_session option, see render_async().
 
     Return base64 data URI as str
     """
-    encoding = 'base64'
-    mimetype = 'image/gif' if 'chan' in self.query else 'image/png'
-    encoded = b64encode(self.to_binary()).decode("utf-8")
-    return 'data:{mimetype};{encoding},{encoded}'.format(mimetype=mimetype, encoding=encoding, encoded=encoded)
+    return _data_uri(self._mimetype(), await self.to_binary_async())
 
-  def to_file(self, path) -> str:
-    """Do a blocking request to Image-Charts API with current configuration and a base64 encoded data URI (blocking)
+  async def to_file_async(self, path):
+    """Do a non-blocking request to Image-Charts API and write the chart image to path
 
+    Connections are only reused through the async_session option, see render_async().
     """
-    with open(path, 'wb') as f:
-      f.write(self.to_binary())
+    content = await self.to_binary_async()
+
+    import asyncio
+
+    def write():
+      with open(path, 'wb') as f:
+        f.write(content)
+
+    await asyncio.get_event_loop().run_in_executor(None, write)
+
+
+def _create_temporary_file(path):
+  # like tempfile.mkstemp next to path, but with the permissions of a file created by open() (0666 minus the umask)
+  # rather than 0600, since it replaces path
+  directory, name = os.path.split(os.path.abspath(path))
+  while True:
+    tmp_path = os.path.join(directory, '.{name}.{suffix}'.format(name=name, suffix=os.urandom(6).hex()))
+    try:
+      return os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666), tmp_path
+    except FileExistsError:
+      continue
+
+def _check_response(status_code, headers, content):
+  if status_code >= 200 and status_code < 300:
+    return content
+  raise _error_for_response(status_code, headers)
+
+def _chunks(content, chunk_size):
+  for offset in range(0, len(content), chunk_size):
+    yield content[offset:offset + chunk_size]
+
+def _stream_content(response, chunk_size, hooks, event, started, deadline):
+  """Yield the body of a streamed response, then report the request to the hooks"""
+  try:
+    with response:
+      headers_at = time.perf_counter()
+      for chunk in response.iter_content(chunk_size=chunk_size):
+        # the read timeout bounds the wait for each chunk, the deadline bounds the whole download
+        if deadline is not None and time.monotonic() > deadline:
+          raise ImageChartsTimeoutError(message='deadline exceeded')
+        event['bytes'] += len(chunk)
+        yield chunk
+      event['timings']['download'] = time.perf_counter() - headers_at
+  except Exception as error:
+    _complete_event(hooks, event, started, error)
+    raise
+  _complete_event(hooks, event, started)
+
+def _data_uri(mimetype, content):
+  from base64 import b64encode
+  encoded = b64encode(content).decode("utf-8")
+  return 'data:{mimetype};{encoding},{encoded}'.format(mimetype=mimetype, encoding='base64', encoded=encoded)
+
+_worker_templates = {}
+
+def _template_urls(base, rows):
+  # runs in worker processes, templates are built once per worker
+  handle, query = base
+  key = (handle.token, query)
+  template = _worker_templates.get(key)
+  if template is None:
+    template = ChartTemplate(ImageCharts(handle, dict(query)))
+    _worker_templates[key] = template
+  return [template.to_url(row) for row in rows]
+
+def _quote(value):
+  # ImageChartsData.ChartData values (DataSeries.chd()) carry their url encoded form
+  if type(value) is not str:
+    quoted = getattr(value, 'quoted', None)
+    if quoted is not None:
+      return quoted
+  return quote_plus(str(value))
+
+def _encode_param(param, value):
+  return param + '=' + _quote(value)
+
+class ChartTemplate:
+  """Freeze a chart to stamp out variants of it, only the varying parameters are encoded and signed
+
+  The url prefix and the static query string are encoded once, signed charts reuse an HMAC state
+  already fed with the static query string.
+
+  - chart :ImageCharts - base chart holding the static parameters and options
+  """
+
+  def __init__(self, chart) -> None:
+    self.chart = chart
+    self._static_query = dict(chart.query)
+    self._static_pieces = [_encode_param(param, value) for param, value in self._static_query.items()]
+    self._static_index = {param: index for index, param in enumerate(self._static_query)}
+    self._static_query_string = '&'.join(self._static_pieces)
+    self._prefix = '{protocol}://{host}:{port}{pathname}?'.format(protocol=chart.protocol, host=chart.host, port=chart.port, pathname=chart.pathname)
+    self._hmac_key = None
+    self._hmac_static = None
+    if chart._config.signer is not None:
+      self._hmac_key = chart._config.signer.key_state
+      self._hmac_static = self._hmac_key.copy()
+      self._hmac_static.update(self._static_query_string.encode('utf-8'))
+
+  def to_url(self, params=None, **kwargs) -> str:
+    """Get the url of the base chart extended with params, same as chaining the parameter methods then calling to_url()"""
+    params = dict(params, **kwargs) if params else kwargs
+    if self.chart._config.validate:
+      messages = validate_query(dict(self._static_query, **params), self.chart.secret)
+      if messages:
+        raise ImageChartsValidationError(error_code='IC_LOCAL_VALIDATION', validation_messages=messages)
+    overrides = [param for param in params if param in self._static_index]
+
+    if overrides:
+      pieces = list(self._static_pieces)
+      for param in overrides:
+        pieces[self._static_index[param]] = _encode_param(param, params[param])
+      delta = '&'.join(_encode_param(param, value) for param, value in params.items() if param not in self._static_index)
+      query_string = '&'.join(pieces) + ('&' + delta if delta else '')
+      signing = self._hmac_key.copy() if self._hmac_key is not None else None
+      signed_part = query_string
+    else:
+      delta = '&'.join(_encode_param(param, value) for param, value in params.items())
+      separator = '&' if delta and self._static_query_string else ''
+      signed_part = separator + delta
+      query_string = self._static_query_string + signed_part
+      signing = self._hmac_static.copy() if self._hmac_static is not None else None
+
+    url = self._prefix + query_string
+    if signing is not None and ('icac' in self._static_query or 'icac' in params):
+      signing.update(signed_part.encode('utf-8'))
+      url += '&ichm=' + signing.hexdigest()
+    return url
+
+  def chart_with(self, params=None, **kwargs):
+    """Get an ImageCharts instance of the base chart extended with params, to download it"""
+    params = dict(params, **kwargs) if params else kwargs
+    chart = self.chart
+    for param, value in params.items():
+      chart = getattr(chart, param)(value)
+    return chart
@@ -6,12 +6,32 @@ from __future__ import print_function
 import os, sys
 import unittest
 import time
+import asyncio
+import json
+import threading
+import tempfile
+import io
+import pickle
+import operator
+import multiprocessing
+import contextlib
+import tarfile
+import subprocess
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 sys.path.insert(0, '.')
 # Run tests from the repository root directory:
 # python ./ImageCharts.test.php
 
-from ImageCharts import ImageCharts
+import ImageCharts as image_charts_module
+import ImageChartsData
+from ImageChartsMockServer import MockChartServer, FakeTransport
+import ImageChartsCLI
+from ImageCharts import ImageCharts, create_session, ChartCache, ChartTemplate, RateLimiter, FileRateLimiter, SingleFlight
+from ImageCharts import ImageChartsError, ImageChartsValidationError, ImageChartsAuthError, ImageChartsRateLimitError, ImageChartsServerError, ImageChartsTimeoutError, ImageChartsConnectionError, validate_query
+from ImageCharts import MetricsAggregator, ChartResponse, RequestsTransport, HTTP2Transport, ConfigHandle
 
 # CI user-agent to bypass rate limiting (set in CI environment)
 CI_USER_AGENT = os.environ.get('IMAGE_CHARTS_USER_AGENT')
@@ -132,5 +152,1099 @@ class TestImageCharts(unittest.TestCase):
     def test__expose_the_query_user_defined(self):
         self.assertEqual(ImageCharts().cht('p').chd('t:1,2,3').icac('plop').query, {'chd' : 't:1,2,3', 'cht' : 'p', 'icac' : 'plop'})
 
+class FakeResponse:
+    def __init__(self, status_code=200, content=b'\x89PNG', headers=None):
+      self.status_code = status_code
+      self.content = content
+      self.headers = headers if headers is not None else {}
+
+    def close(self):
+      pass
+
+    def iter_content(self, chunk_size=1):
+      for offset in range(0, len(self.content), chunk_size):
+        yield self.content[offset:offset + chunk_size]
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *args):
+      pass
+
+class FakeSession:
+    def __init__(self, responses=None):
+      self.responses = list(responses) if responses else []
+      self.calls = []
+
+    def get(self, url, **kwargs):
+      self.calls.append((url, kwargs))
+      return self.responses.pop(0) if self.responses else FakeResponse()
+
+class TestImageChartsSession(unittest.TestCase):
+    def test__reuses_the_session_passed_through_options(self):
+      session = FakeSession()
+      chart = ImageCharts({'session': session}).cht('p').chd('t:1,2,3').chs('2x2')
+      chart.to_binary()
+      chart.chs('4x4').to_data_uri()
+      self.assertEqual(len(session.calls), 2)
+      self.assertTrue(chart.chs('4x4').session is session)
+
+    def test__creates_a_pooled_session_from_options(self):
+      chart = ImageCharts({'pool_maxsize': 32, 'pool_connections': 2})
+      adapter = chart.session.get_adapter('https://image-charts.com')
+      self.assertEqual(adapter._pool_maxsize, 32)
+      self.assertEqual(adapter._pool_connections, 2)
+      self.assertTrue(chart.cht('p').session is chart.session)
+
+    def test__shares_a_default_session_between_charts(self):
+      self.assertTrue(image_charts_module._get_default_session() is image_charts_module._get_default_session())
+      self.assertTrue(ImageCharts().session is None)
+
+PNG_BODY = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+def start_local_server(**kwargs):
+    return MockChartServer(png=PNG_BODY, **kwargs).start()
+
+def local_options(server, opts=None):
+    return server.options(opts)
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+      return loop.run_until_complete(coroutine)
+    finally:
+      loop.close()
+
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestImageChartsAsync(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+      cls.server = start_local_server()
+
+    @classmethod
+    def tearDownClass(cls):
+      cls.server.stop()
+
+    def test__to_binary_async_works(self):
+      chart = ImageCharts(local_options(self.server)).cht('p').chd('t:1,2,3').chs('2x2')
+      self.assertEqual(run_async(chart.to_binary_async()), PNG_BODY)
+
+    def test__to_binary_async_rejects_with_validation_message(self):
+      chart = ImageCharts(local_options(self.server)).cht('p').chd('t:1,2,3')
+      with self.assertRaisesRegex(Exception, '"chs" is required'):
+        run_async(chart.to_binary_async())
+
+    def test__to_data_uri_async_and_to_file_async_share_a_session(self):
+      async def render():
+        session = image_charts_module.create_async_session(limit=4)
+        try:
+          chart = ImageCharts(local_options(self.server, {'async_session': session})).cht('p').chd('t:1,2,3').chs('2x2')
+          await chart.to_file_async('/tmp/chart_async.png')
+          return await chart.chan('100').to_data_uri_async()
+        finally:
+          await session.close()
+      self.assertTrue(run_async(render()).startswith('data:image/gif;base64,R0lGODlh'))
+      with open('/tmp/chart_async.png', 'rb') as f:
+        self.assertEqual(f.read(), PNG_BODY)
+
+class TestImageChartsRenderMany(unittest.TestCase):
+    def test__renders_in_input_order_and_reports_errors(self):
+      session = FakeSession([FakeResponse(), FakeResponse(400, headers={'x-ic-error-code': 'IC_MISSING_CHS'}), FakeResponse()])
+      chart = ImageCharts({'session': session}).cht('p').chd('t:1,2,3')
+      charts = [chart.chs('{size}x{size}'.format(size=size)) for size in (2, 3, 4)]
+      results = list(ImageCharts.render_many(charts, concurrency=1))
+      self.assertEqual([result.index for result in results], [0, 1, 2])
+      self.assertEqual(results[0].content, b'\x89PNG')
+      self.assertEqual(str(results[1].error), 'IC_MISSING_CHS')
+      self.assertTrue(results[2].chart is charts[2])
+
+    def test__yields_results_as_completed(self):
+      chart = ImageCharts({'session': FakeSession()}).cht('p').chd('t:1,2,3')
+      results = list(ImageCharts.render_many([chart.chs('2x2')] * 20, concurrency=4, ordered=False))
+      self.assertEqual(sorted(result.index for result in results), list(range(20)))
+
+    def test__respects_the_rate_limit(self):
+      chart = ImageCharts({'session': FakeSession()}).cht('p').chd('t:1,2,3').chs('2x2')
+      start = time.monotonic()
+      list(ImageCharts.render_many([chart] * 5, concurrency=5, rate_limit=50))
+      self.assertTrue(time.monotonic() - start >= 0.07)
+
+class TestImageChartsCache(unittest.TestCase):
+    def test__serves_identical_charts_from_the_cache(self):
+      session = FakeSession()
+      cache = ChartCache()
+      chart = ImageCharts({'session': session, 'cache': cache}).cht('p').chd('t:1,2,3').chs('2x2')
+      self.assertEqual(chart.to_binary(), b'\x89PNG')
+      self.assertEqual(chart.to_data_uri(), 'data:image/png;base64,iVBORw==')
+      chart.chs('4x4').to_binary()
+      self.assertEqual(len(session.calls), 2)
+      self.assertEqual((cache.hits, cache.memory_hits, cache.misses), (1, 1, 2))
+
+    def test__does_not_cache_errors(self):
+      session = FakeSession([FakeResponse(400, headers={'x-ic-error-code': 'IC_MISSING_CHS'})])
+      chart = ImageCharts({'session': session, 'cache': ChartCache()}).cht('p')
+      with self.assertRaisesRegex(Exception, 'IC_MISSING_CHS'):
+        chart.to_binary()
+      self.assertEqual(chart.to_binary(), b'\x89PNG')
+
+    def test__evicts_least_recently_used_charts_over_the_memory_budget(self):
+      cache = ChartCache(memory_bytes=10)
+      cache.set('a', b'12345')
+      cache.set('b', b'12345')
+      cache.get('a')
+      cache.set('c', b'12345')
+      self.assertEqual(cache.get('b'), None)
+      self.assertEqual(cache.get('a'), b'12345')
+      self.assertEqual(cache.stats()['memory_bytes'], 10)
+
+    def test__reads_from_disk_and_honors_ttl_and_disk_budget(self):
+      directory = tempfile.mkdtemp()
+      ChartCache(directory=directory).set('a', b'12345')
+      entry_size = os.path.getsize(ChartCache(directory=directory)._disk_path('a'))
+      cache = ChartCache(memory_bytes=0, directory=directory, disk_bytes=2 * entry_size, ttl=60)
+      self.assertEqual(cache.get('a'), b'12345')
+      self.assertEqual(cache.disk_hits, 1)
+      os.utime(cache._disk_path('a'), (0, 0))
+      cache.set('b', b'12345')
+      cache.set('c', b'12345')
+      self.assertEqual(cache.get('a'), None)
+      self.assertEqual(cache.get('c'), b'12345')
+      self.assertTrue(cache.stats()['disk_bytes'] <= 2 * entry_size)
+
+    def test__only_counts_and_removes_its_own_files(self):
+      directory = tempfile.mkdtemp()
+      with open(os.path.join(directory, 'report.pdf'), 'wb') as f:
+        f.write(b'%PDF' * 100)
+      ChartCache(directory=directory).set('a', b'12345')
+      entry_size = os.path.getsize(ChartCache(directory=directory)._disk_path('a'))
+      cache = ChartCache(memory_bytes=0, directory=directory, disk_bytes=entry_size + 16)
+      self.assertEqual(cache.stats()['disk_bytes'], entry_size)
+      os.utime(cache._disk_path('a'), (0, 0))
+      cache.set('b', b'12345')
+      self.assertEqual((cache.get('a'), cache.get('b')), (None, b'12345'))
+      cache.clear()
+      self.assertEqual(os.listdir(directory), ['report.pdf'])
+
+    def test__revalidates_stale_charts_with_validators(self):
+      cache = ChartCache()
+      session = FakeSession([
+        FakeResponse(headers={'etag': '"v1"', 'last-modified': 'Wed, 21 Oct 2015 07:28:00 GMT', 'cache-control': 'max-age=0'}),
+        FakeResponse(304, b'', headers={'cache-control': 'max-age=3600'})
+      ])
+      chart = ImageCharts({'session': session, 'cache': cache}).cht('p').chd('t:1,2,3').chs('2x2')
+      chart.to_binary()
+      self.assertEqual(chart.to_binary(), b'\x89PNG')
+      self.assertEqual(chart.request_headers['if-none-match'], '"v1"')
+      self.assertEqual(chart.request_headers['if-modified-since'], 'Wed, 21 Oct 2015 07:28:00 GMT')
+      self.assertEqual(chart.to_binary(), b'\x89PNG')
+      self.assertEqual(len(session.calls), 2)
+      self.assertEqual((cache.hits, cache.revalidations), (1, 1))
+
+    def test__does_not_store_no_store_responses(self):
+      cache = ChartCache()
+      cache.set('a', b'12345', {'cache-control': 'private, no-store'})
+      self.assertEqual(cache.get('a'), None)
+
+class TestImageChartsStreaming(unittest.TestCase):
+    def test__iter_binary_streams_chunks(self):
+      session = FakeSession([FakeResponse(content=PNG_BODY)])
+      chunks = list(ImageCharts({'session': session}).cht('p').chd('t:1,2,3').chs('2x2').iter_binary(chunk_size=16))
+      self.assertEqual(b''.join(chunks), PNG_BODY)
+      self.assertEqual(max(len(chunk) for chunk in chunks), 16)
+      self.assertTrue(session.calls[0][1]['stream'])
+
+    def test__iter_binary_rejects_on_error(self):
+      session = FakeSession([FakeResponse(400, headers={'x-ic-error-code': 'IC_MISSING_CHS'})])
+      with self.assertRaisesRegex(Exception, 'IC_MISSING_CHS'):
+        list(ImageCharts({'session': session}).cht('p').iter_binary())
+
+    def test__write_data_uri_matches_to_data_uri(self):
+      for size in (10, 11, 12):
+        content = bytes(range(size)) * 7
+        out = io.StringIO()
+        ImageCharts({'session': FakeSession([FakeResponse(content=content)])}).chan('1').write_data_uri(out, chunk_size=4)
+        self.assertEqual(out.getvalue(), 'data:image/gif;base64,' + b64encode(content).decode('ascii'))
+
+    def test__to_file_writes_atomically(self):
+      directory = tempfile.mkdtemp()
+      path = os.path.join(directory, 'chart.png')
+      with open(path, 'wb') as f:
+        f.write(b'previous')
+      session = FakeSession([FakeResponse(400, headers={'x-ic-error-code': 'IC_MISSING_CHS'}), FakeResponse(content=PNG_BODY)])
+      chart = ImageCharts({'session': session}).cht('p')
+      with self.assertRaisesRegex(Exception, 'IC_MISSING_CHS'):
+        chart.to_file(path)
+      with open(path, 'rb') as f:
+        self.assertEqual(f.read(), b'previous')
+      chart.to_file(path, chunk_size=8)
+      with open(path, 'rb') as f:
+        self.assertEqual(f.read(), PNG_BODY)
+      self.assertEqual(os.listdir(directory), ['chart.png'])
+
+    def test__to_file_creates_files_with_default_permissions(self):
+      directory = tempfile.mkdtemp()
+      umask = os.umask(0o022)
+      try:
+        ImageCharts({'session': FakeSession()}).cht('p').chs('2x2').to_file(os.path.join(directory, 'chart.png'))
+      finally:
+        os.umask(umask)
+      self.assertEqual(os.stat(os.path.join(directory, 'chart.png')).st_mode & 0o777, 0o644)
+
+class TestImageChartsBuilder(unittest.TestCase):
+    def test__releases_parent_charts_once_the_query_is_built(self):
+      import gc
+
+      def live_charts():
+        gc.collect()
+        return sum(1 for obj in gc.get_objects() if isinstance(obj, ImageCharts))
+
+      before = live_charts()
+      chart = ImageCharts().cht('lc').chs('10x10')
+      for i in range(1000):
+        chart = chart.chd('t:{}'.format(i))
+        chart.to_url()
+      self.assertEqual(live_charts() - before, 1)
+      self.assertEqual(chart._parent, None)
+      self.assertEqual(chart.query, {'cht': 'lc', 'chs': '10x10', 'chd': 't:999'})
+      self.assertEqual(chart.chtt('title').to_url(), ImageCharts().cht('lc').chs('10x10').chd('t:999').chtt('title').to_url())
+
+    def test__builds_the_query_of_a_shared_chart_once(self):
+      params = sorted(name for name in vars(ImageCharts) if name.startswith('ch') and callable(vars(ImageCharts)[name]))[:30]
+      switch_interval = sys.getswitchinterval()
+      sys.setswitchinterval(1e-6)
+      try:
+        for run in range(1000):
+          chart = ImageCharts()
+          for param in params:
+            chart = getattr(chart, param)('1')
+          barrier = threading.Barrier(4)
+          queries = []
+
+          def read():
+            barrier.wait()
+            queries.append(chart.query)
+
+          threads = [threading.Thread(target=read) for _ in range(4)]
+          for thread in threads:
+            thread.start()
+          for thread in threads:
+            thread.join()
+          self.assertEqual(queries, [dict.fromkeys(params, '1')] * 4)
+      finally:
+        sys.setswitchinterval(switch_interval)
+
+    def test__keeps_parent_charts_unchanged(self):
+      base = ImageCharts().cht('p').chs('2x2')
+      pie = base.chd('t:1,2,3')
+      bar = base.cht('bvg').chd('t:4,5')
+      self.assertEqual(base.query, {'cht': 'p', 'chs': '2x2'})
+      self.assertEqual(list(bar.query.items()), [('cht', 'bvg'), ('chs', '2x2'), ('chd', 't:4,5')])
+      self.assertEqual(pie.to_url(), 'https://image-charts.com:443/chart?cht=p&chs=2x2&chd=t%3A1%2C2%2C3')
+
+    def test__extends_the_query_passed_to_the_constructor(self):
+      previous = {'cht': 'p'}
+      chart = ImageCharts({'host': 'example.com'}, previous).chs('2x2')
+      self.assertEqual(chart.query, {'cht': 'p', 'chs': '2x2'})
+      self.assertEqual(previous, {'cht': 'p'})
+      self.assertEqual(chart.host, 'example.com')
+
+    def test__shares_options_by_reference(self):
+      base = ImageCharts({'secret': 'plop'})
+      self.assertTrue(base.cht('p').chs('2x2')._config is base._config)
+
+class TestChartTemplate(unittest.TestCase):
+    def test__generates_the_same_urls_as_the_builder(self):
+      base = ImageCharts().cht('bvg').chs('300x300').chco('FF0000')
+      template = ChartTemplate(base)
+      self.assertEqual(template.to_url(chd='a:1,2', chl='a|b'), base.chd('a:1,2').chl('a|b').to_url())
+      self.assertEqual(template.to_url({'chs': '100x100'}, chd='a:1'), base.chs('100x100').chd('a:1').to_url())
+      self.assertEqual(template.to_url(), base.to_url())
+      self.assertEqual(ChartTemplate(ImageCharts()).to_url(cht='p'), ImageCharts().cht('p').to_url())
+
+    def test__signs_like_the_builder(self):
+      base = ImageCharts({'secret': 'plop'}).cht('p').chs('100x100').icac('test_fixture')
+      template = ChartTemplate(base)
+      for params in ({'chd': 't:1,2,3'}, {'chs': '200x200', 'chd': 't:1'}, {}):
+        self.assertEqual(template.to_url(params), template.chart_with(params).to_url())
+      self.assertEqual(ChartTemplate(ImageCharts({'secret': 'plop'}).cht('p')).to_url(icac='test_fixture'), ImageCharts({'secret': 'plop'}).cht('p').icac('test_fixture').to_url())
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+class TestImageChartsData(unittest.TestCase):
+    def test__encodes_text_and_auto_scaled_series(self):
+      self.assertEqual(ImageChartsData.encode([1, 2.5, None, 4]), 'a:1,2.5,_,4')
+      self.assertEqual(ImageChartsData.encode([[1, 2], (3, 4)], 't'), 't:1,2|3,4')
+      self.assertEqual(ImageChartsData.encode([1.234, 5.678], 't', precision=1), 't:1.2,5.7')
+
+    def test__encodes_simple_and_extended_series(self):
+      self.assertEqual(ImageChartsData.encode([0, 30.5, 61, None], 's'), 's:Ae9_')
+      self.assertEqual(ImageChartsData.encode([[0, 4095], [None, 64]], 'e'), 'e:AA..,__BA')
+      self.assertEqual(ImageChartsData.encode([5, 10], 's', scale=(0, 10)), 's:e9')
+
+    def test__computes_chds(self):
+      self.assertEqual(ImageChartsData.chds([[1, 5], [-2.5, 3]]), '-2.5,5')
+      self.assertEqual(ImageChartsData.chds([[1, 5], [-2.5, 3]], per_series=True), '1,5,-2.5,3')
+
+    def test__downsamples_to_the_chart_width(self):
+      values = [0] * 1000
+      values[500] = 10
+      self.assertTrue(ImageChartsData.encode(values, 't', chs='100x50').count(',') < 100)
+      self.assertTrue(10 in ImageChartsData.downsample(values, 100))
+      self.assertTrue(10 in ImageChartsData.downsample(values, 100, 'lttb'))
+      self.assertEqual(ImageChartsData.downsample([1, 2, 3], 100), [1, 2, 3])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test__numpy_arrays_match_lists(self):
+      values = [float(value % 97) / 7 for value in range(5000)]
+      values[10] = None
+      array = numpy.array([numpy.nan if value is None else value for value in values])
+      for encoding in ('t', 's', 'e'):
+        self.assertEqual(ImageChartsData.encode(array, encoding, precision=2), ImageChartsData.encode(values, encoding, precision=2))
+      self.assertEqual(ImageChartsData.downsample(array, 300).tolist(), ImageChartsData.downsample(values, 300))
+      self.assertEqual(len(ImageChartsData.downsample(array, 300, 'lttb')), 300)
+      self.assertEqual(ImageChartsData.encode(numpy.array([[1, 2], [3, 4]]), 't'), 't:1,2|3,4')
+      self.assertEqual(ImageChartsData.encode(numpy.array([True, False, True]), 't'), 't:1,0,1')
+
+class TestImageChartsToUrls(unittest.TestCase):
+    def test__generates_urls_from_rows(self):
+      base = ImageCharts({'secret': 'plop'}).cht('p').chs('100x100').icac('test_fixture')
+      rows = [{'chd': 't:{}'.format(i), 'chl': 'a|b'} for i in range(5)]
+      self.assertEqual(list(base.to_urls(rows)), [base.chd(row['chd']).chl(row['chl']).to_url() for row in rows])
+
+    def test__generates_urls_from_columns(self):
+      base = ImageCharts().cht('p')
+      self.assertEqual(list(base.to_urls({'chd': ['t:1', 't:2'], 'chs': ['2x2', '3x3']})), [base.chd('t:1').chs('2x2').to_url(), base.chd('t:2').chs('3x3').to_url()])
+
+    def test__generates_urls_in_worker_processes(self):
+      base = ImageCharts({'secret': 'plop'}).cht('p').icac('test_fixture')
+      rows = [{'chd': 't:{}'.format(i)} for i in range(50)]
+      self.assertEqual(list(base.to_urls(iter(rows), processes=2, chunksize=7)), list(base.to_urls(rows)))
+
+class RaisingSession(FakeSession):
+    def __init__(self, errors, responses=None):
+      super().__init__(responses)
+      self.errors = list(errors)
+
+    def get(self, url, **kwargs):
+      if self.errors:
+        self.calls.append((url, kwargs))
+        raise self.errors.pop(0)
+      return super().get(url, **kwargs)
+
+class TestImageChartsRetries(unittest.TestCase):
+    def test__does_not_retry_by_default(self):
+      session = FakeSession([FakeResponse(503, headers={'x-ic-error-code': 'IC_SERVER_ERROR'})])
+      with self.assertRaisesRegex(Exception, 'IC_SERVER_ERROR'):
+        ImageCharts({'session': session}).cht('p').chs('2x2').to_binary()
+      self.assertEqual(len(session.calls), 1)
+
+    def test__retries_rate_limited_requests_honoring_retry_after(self):
+      session = FakeSession([FakeResponse(429, headers={'retry-after': '0.05'}), FakeResponse(503), FakeResponse()])
+      start = time.monotonic()
+      content = ImageCharts({'session': session, 'max_retries': 2, 'backoff_factor': 0.01}).cht('p').chs('2x2').to_binary()
+      self.assertEqual(content, b'\x89PNG')
+      self.assertEqual(len(session.calls), 3)
+      self.assertTrue(time.monotonic() - start >= 0.05)
+
+    def test__gives_up_after_max_retries(self):
+      session = FakeSession([FakeResponse(429, headers={'x-ic-error-code': 'IC_RATE_LIMITED'})] * 3)
+      with self.assertRaisesRegex(Exception, 'IC_RATE_LIMITED'):
+        ImageCharts({'session': session, 'max_retries': 2, 'backoff_factor': 0}).cht('p').chs('2x2').to_binary()
+      self.assertEqual(len(session.calls), 3)
+
+    def test__retries_connection_errors(self):
+      session = RaisingSession([requests.ConnectionError('reset')])
+      self.assertEqual(ImageCharts({'session': session, 'max_retries': 1, 'backoff_factor': 0}).cht('p').chs('2x2').to_binary(), b'\x89PNG')
+      self.assertEqual(len(session.calls), 2)
+
+    def test__computes_retry_delays(self):
+      self.assertEqual(image_charts_module._retry_delay(0, '3', 1, 30), 3.0)
+      self.assertEqual(image_charts_module._retry_delay(0, '300', 1, 30), 30)
+      self.assertEqual(image_charts_module._retry_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT', 1, 30), 0)
+      for attempt in range(5):
+        self.assertTrue(0 <= image_charts_module._retry_delay(attempt, None, 0.5, 4) <= min(4, 0.5 * 2 ** attempt))
+
+    def test__throttles_requests_with_a_shared_rate_limiter(self):
+      limiter = RateLimiter(50)
+      chart = ImageCharts({'session': FakeSession(), 'rate_limiter': limiter}).cht('p').chs('2x2')
+      start = time.monotonic()
+      for _ in range(4):
+        chart.to_binary()
+      self.assertTrue(time.monotonic() - start >= 0.05)
+
+    def test__shares_a_rate_limiter_through_a_file(self):
+      path = os.path.join(tempfile.mkdtemp(), 'limiter')
+      first, second = FileRateLimiter(path, 50), FileRateLimiter(path, 50)
+      start = time.monotonic()
+      for limiter in (first, second, first, second):
+        limiter.acquire()
+      self.assertTrue(time.monotonic() - start >= 0.05)
+
+class SlowSession(FakeSession):
+    def __init__(self, delay, responses=None):
+      super().__init__(responses)
+      self.delay = delay
+
+    def get(self, url, **kwargs):
+      time.sleep(self.delay)
+      return super().get(url, **kwargs)
+
+class TestImageChartsSingleFlight(unittest.TestCase):
+    def test__coalesces_concurrent_identical_requests(self):
+      session = SlowSession(0.1)
+      chart = ImageCharts({'session': session, 'coalesce': SingleFlight()}).cht('p').chs('2x2')
+      results = list(ImageCharts.render_many([chart] * 5 + [chart.chs('3x3')], concurrency=6))
+      self.assertEqual([result.content for result in results], [b'\x89PNG'] * 6)
+      self.assertEqual(len(session.calls), 2)
+
+    def test__shares_the_same_exception(self):
+      session = SlowSession(0.1, [FakeResponse(400, headers={'x-ic-error-code': 'IC_MISSING_CHS'})])
+      chart = ImageCharts({'session': session, 'coalesce': True}).cht('p')
+      results = list(ImageCharts.render_many([chart] * 3, concurrency=3))
+      self.assertEqual(len(session.calls), 1)
+      self.assertTrue(all(str(result.error) == 'IC_MISSING_CHS' for result in results))
+
+    def test__coalesces_asyncio_tasks(self):
+      calls = []
+      async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'done'
+      async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(*[flight.do_async('key', fetch) for _ in range(4)])
+      self.assertEqual(run_async(run()), ['done'] * 4)
+      self.assertEqual(len(calls), 1)
+
+    def test__keeps_asyncio_calls_running_when_a_caller_is_cancelled(self):
+      calls = []
+      async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'done'
+      async def run():
+        flight = SingleFlight()
+        leader = asyncio.ensure_future(flight.do_async('key', fetch))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.do_async('key', fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(leader, *followers, return_exceptions=True)
+        return results, flight._tasks
+      results, tasks = run_async(run())
+      self.assertIsInstance(results[0], asyncio.CancelledError)
+      self.assertEqual(results[1:], ['done'] * 3)
+      self.assertEqual((len(calls), tasks), (1, {}))
+
+class TestImageChartsErrors(unittest.TestCase):
+    def render(self, response):
+      with self.assertRaises(ImageChartsError) as context:
+        ImageCharts({'session': FakeSession([response])}).cht('p').chs('2x2').to_binary()
+      return context.exception
+
+    def test__raises_validation_errors_with_every_message(self):
+      validation = json.dumps([{'message': '"chs" is required'}, {'message': '"cht" is required'}])
+      error = self.render(FakeResponse(400, headers={'x-ic-error-code': 'IC_VALIDATION', 'x-ic-error-validation': validation}))
+      self.assertIsInstance(error, ImageChartsValidationError)
+      self.assertEqual((error.status_code, error.error_code, error.retryable), (400, 'IC_VALIDATION', False))
+      self.assertEqual(error.validation_messages, ['"chs" is required', '"cht" is required'])
+      self.assertEqual(str(error), '"chs" is required')
+
+    def test__classifies_errors_by_status_code(self):
+      self.assertIsInstance(self.render(FakeResponse(403, headers={'x-ic-error-code': 'IC_ACCOUNT_NOT_FOUND'})), ImageChartsAuthError)
+      self.assertIsInstance(self.render(FakeResponse(502)), ImageChartsServerError)
+      error = self.render(FakeResponse(429, headers={'retry-after': '2'}))
+      self.assertIsInstance(error, ImageChartsRateLimitError)
+      self.assertEqual((str(error), error.retry_after, error.retryable), ('HTTP_429', '2', True))
+
+    def test__wraps_network_errors(self):
+      session = RaisingSession([requests.ReadTimeout('read timed out'), requests.ConnectionError('refused')])
+      chart = ImageCharts({'session': session}).cht('p').chs('2x2')
+      with self.assertRaisesRegex(ImageChartsTimeoutError, 'timed out'):
+        chart.to_binary()
+      with self.assertRaisesRegex(ImageChartsConnectionError, 'refused'):
+        chart.to_binary()
+
+    def test__errors_can_be_pickled(self):
+      import pickle
+      error = pickle.loads(pickle.dumps(ImageChartsRateLimitError(429, 'IC_RATE_LIMITED', {'retry-after': '1'})))
+      self.assertEqual((type(error), error.status_code, error.retry_after), (ImageChartsRateLimitError, 429, '1'))
+      headers = requests.structures.CaseInsensitiveDict({'Retry-After': '2', 'X-Ic-Error-Validation': json.dumps([{'message': 'too many'}])})
+      error = pickle.loads(pickle.dumps(ImageChartsRateLimitError(429, 'IC_RATE_LIMITED', headers)))
+      self.assertEqual((error.retry_after, str(error)), ('2', 'too many'))
+
+class TestImageChartsValidation(unittest.TestCase):
+    def test__accepts_valid_charts(self):
+      self.assertEqual(validate_query({'cht': 'bvs', 'chs': '999x999', 'chd': 't:1,2.5,_|3,-4e2', 'chco': 'FF0000,00ff00AA|123456', 'chf': 'bg,s,FFFFFF|b0,lg,90,EA469EFF,1,03A9F47C,0.4'}), [])
+      self.assertEqual(validate_query({'cht': 'lc', 'chs': '10x10', 'chd': 'e:AA..,__'}), [])
+      self.assertEqual(validate_query({'cht': 'qr', 'chs': '10x10', 'chl': 'hello', 'icac': 'account'}, 'secret'), [])
+
+    def test__reports_every_problem(self):
+      messages = validate_query({'cht': 'nope', 'chs': '1000x10', 'chd': 's:A,B!', 'chco': 'red', 'chf': 'bg,s,red', 'icac': 'account'})
+      self.assertEqual(len(messages), 6)
+      self.assertEqual(validate_query({}), ['"cht" is required', '"chs" is required', '"chd" is required'])
+      self.assertEqual(validate_query({'cht': 'qr', 'chs': '10x10'}), ['"chl" is required by "cht=qr" charts'])
+
+    def test__fails_fast_before_any_request(self):
+      session = FakeSession()
+      chart = ImageCharts({'session': session, 'validate': True}).cht('p').chd('t:1,2,3')
+      with self.assertRaisesRegex(ImageChartsValidationError, '"chs" is required') as context:
+        chart.to_binary()
+      self.assertEqual(context.exception.status_code, None)
+      self.assertEqual(session.calls, [])
+      self.assertEqual(chart.chs('2x2').to_binary(), b'\x89PNG')
+
+    def test__checks_template_and_to_urls_parameters(self):
+      chart = ImageCharts({'validate': True}).cht('p').chs('10x10')
+      with self.assertRaises(ImageChartsValidationError):
+        list(chart.to_urls([{'chd': 'bogus'}]))
+      with self.assertRaises(ImageChartsValidationError):
+        ChartTemplate(chart).to_url(chd='bogus')
+      self.assertEqual(list(chart.to_urls([{'chd': 't:1,2'}])), [chart.chd('t:1,2').to_url()])
+
+class RecordingHook:
+    def __init__(self):
+      self.calls = []
+
+    def before_request(self, event):
+      self.calls.append(('before_request', dict(event)))
+
+    def after_response(self, event):
+      self.calls.append(('after_response', dict(event)))
+
+    def on_error(self, event):
+      self.calls.append(('on_error', dict(event)))
+
+class TestImageChartsHooks(unittest.TestCase):
+    def test__reports_requests_and_retries(self):
+      hook = RecordingHook()
+      session = FakeSession([FakeResponse(503), FakeResponse(200, PNG_BODY)])
+      chart = ImageCharts({'session': session, 'hooks': [hook], 'max_retries': 1, 'backoff_factor': 0}).cht('p').chd('t:1,2,3').chs('2x2')
+      chart.to_binary()
+      self.assertEqual([name for name, event in hook.calls], ['before_request', 'after_response'])
+      event = hook.calls[-1][1]
+      self.assertEqual((event['cht'], event['status_code'], event['bytes'], event['retries'], event['cache']), ('p', 200, len(PNG_BODY), 1, None))
+      self.assertEqual(event['url'], chart.to_url())
+      self.assertTrue(event['timings']['total'] >= event['timings']['download'] >= 0)
+      self.assertEqual(event['timings']['dns'], None)
+
+    def test__reports_errors_and_cache_hits(self):
+      hook = RecordingHook()
+      session = FakeSession([FakeResponse(400, b'', {'x-ic-error-code': 'IC_MISSING_ARGUMENT'}), FakeResponse(200, PNG_BODY, {'cache-control': 'max-age=60'})])
+      chart = ImageCharts({'session': session, 'hooks': [hook], 'cache': ChartCache()}).cht('p').chd('t:1,2,3').chs('2x2')
+      with self.assertRaises(ImageChartsValidationError):
+        chart.to_binary()
+      chart.to_binary()
+      chart.to_binary()
+      self.assertEqual([name for name, event in hook.calls], ['before_request', 'on_error', 'before_request', 'after_response', 'after_response'])
+      self.assertEqual(hook.calls[1][1]['error'].error_code, 'IC_MISSING_ARGUMENT')
+      self.assertEqual([event['cache'] for name, event in hook.calls[3:]], ['miss', 'hit'])
+      self.assertEqual(len(session.calls), 2)
+
+    def test__logs_hook_errors_without_changing_the_outcome(self):
+      class FailingHook:
+        def __getattr__(self, name):
+          def callback(event):
+            raise RuntimeError(name)
+          return callback
+
+      session = FakeSession([FakeResponse(200, PNG_BODY), FakeResponse(400, b'', {'x-ic-error-code': 'IC_MISSING_ARGUMENT'})])
+      hook = RecordingHook()
+      chart = ImageCharts({'session': session, 'hooks': [FailingHook(), hook]}).cht('p').chd('t:1,2,3').chs('2x2')
+      with self.assertLogs('ImageCharts', 'ERROR') as logs:
+        self.assertEqual(chart.to_binary(), PNG_BODY)
+        with self.assertRaisesRegex(ImageChartsValidationError, 'IC_MISSING_ARGUMENT'):
+          chart.to_binary()
+      self.assertEqual([name for name, event in hook.calls], ['before_request', 'after_response', 'before_request', 'on_error'])
+      self.assertEqual(len(logs.records), 4)
+      self.assertIn('after_response hook', logs.output[1])
+
+    def test__reports_streamed_bytes(self):
+      hook = RecordingHook()
+      chart = ImageCharts({'session': FakeSession([FakeResponse(200, PNG_BODY)]), 'hooks': [hook]}).cht('p').chd('t:1,2,3').chs('2x2')
+      self.assertEqual(b''.join(chart.iter_binary(chunk_size=10)), PNG_BODY)
+      self.assertEqual(hook.calls[-1][0], 'after_response')
+      self.assertEqual(hook.calls[-1][1]['bytes'], len(PNG_BODY))
+
+    def test__aggregates_metrics_per_chart_type(self):
+      metrics = MetricsAggregator(buckets=(1, 10))
+      session = FakeSession([FakeResponse(200, PNG_BODY), FakeResponse(200, PNG_BODY), FakeResponse(503, b'', {'x-ic-error-code': 'IC_RENDER_FAILED'})])
+      chart = ImageCharts({'session': session, 'hooks': [metrics]}).chd('t:1,2,3').chs('2x2')
+      chart.cht('p').to_binary()
+      chart.cht('p').to_binary()
+      with self.assertRaises(ImageChartsServerError):
+        chart.cht('bvs').to_binary()
+      snapshot = metrics.snapshot()
+      self.assertEqual(snapshot['p']['requests'], 2)
+      self.assertEqual(snapshot['p']['bytes'], 2 * len(PNG_BODY))
+      self.assertEqual(snapshot['p']['latency']['buckets'], [2, 0, 0])
+      self.assertEqual(snapshot['bvs']['errors'], {'IC_RENDER_FAILED': 1})
+      metrics.reset()
+      self.assertEqual(metrics.snapshot(), {})
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test__reports_async_connection_timings(self):
+      server = start_local_server()
+      hook = RecordingHook()
+      async def render():
+        session = image_charts_module.create_async_session()
+        try:
+          chart = ImageCharts(local_options(server, {'async_session': session, 'hooks': [hook]})).cht('p').chd('t:1,2,3').chs('2x2')
+          return await chart.to_binary_async()
+        finally:
+          await session.close()
+      try:
+        self.assertEqual(run_async(render()), PNG_BODY)
+      finally:
+        server.stop()
+      timings = hook.calls[-1][1]['timings']
+      self.assertTrue(timings['connect'] is not None and timings['ttfb'] is not None)
+      self.assertEqual(hook.calls[-1][1]['bytes'], len(PNG_BODY))
+
+class TestImageChartsTimeouts(unittest.TestCase):
+    def test__converts_millisecond_timeouts_to_seconds(self):
+      session = FakeSession()
+      ImageCharts({'session': session}).cht('p').chd('t:1,2,3').chs('2x2').to_binary()
+      ImageCharts({'session': session, 'connect_timeout': 500, 'read_timeout': 20000}).cht('p').chd('t:1,2,3').chs('2x2').to_binary()
+      self.assertEqual([kwargs['timeout'] for url, kwargs in session.calls], [(5.0, 5.0), (0.5, 20.0)])
+
+    def test__deadline_covers_retries(self):
+      session = FakeSession([FakeResponse(503, headers={'retry-after': '0.2', 'x-ic-error-code': 'IC_SERVER_ERROR'})] * 5)
+      chart = ImageCharts({'session': session, 'max_retries': 4, 'deadline': 300}).cht('p').chd('t:1,2,3').chs('2x2')
+      start = time.monotonic()
+      with self.assertRaises(ImageChartsServerError):
+        chart.to_binary()
+      self.assertTrue(time.monotonic() - start < 0.3)
+      self.assertEqual(len(session.calls), 2)
+      # the second attempt only gets the time left before the deadline
+      self.assertTrue(all(timeout <= 0.1 for timeout in session.calls[1][1]['timeout']))
+
+    def test__batch_deadline_cancels_outstanding_renders(self):
+      chart = ImageCharts({'session': SlowSession(0.2)}).cht('p').chd('t:1,2,3').chs('2x2')
+      start = time.monotonic()
+      results = list(ImageCharts.render_many([chart] * 5, concurrency=1, deadline=300))
+      self.assertTrue(time.monotonic() - start < 1)
+      self.assertEqual([result.index for result in results], [0, 1, 2, 3, 4])
+      self.assertEqual(results[0].content, b'\x89PNG')
+      self.assertTrue(all(isinstance(result.error, ImageChartsTimeoutError) for result in results[1:]))
+
+class TestImageChartsMockServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+      cls.server = MockChartServer(accounts={'test_fixture': 'plop'}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+      cls.server.stop()
+
+    def chart(self, opts=None):
+      return ImageCharts(self.server.options(opts)).cht('p').chd('t:1,2,3')
+
+    def test__renders_png_and_gif_charts(self):
+      self.assertEqual(self.chart().chs('2x2').to_data_uri()[:30], 'data:image/png;base64,iVBORw0K')
+      self.assertEqual(self.chart().chan('100').chs('2x2').to_data_uri()[:30], 'data:image/gif;base64,R0lGODlh')
+
+    def test__rejects_like_image_charts(self):
+      with self.assertRaisesRegex(ImageChartsValidationError, '"chs" is required'):
+        self.chart().to_binary()
+      with self.assertRaisesRegex(ImageChartsAuthError, 'HMAC-SHA256 request signature'):
+        self.chart().chs('2x2').icac('test_fixture').to_binary()
+      with self.assertRaisesRegex(ImageChartsAuthError, 'you must be an Image-Charts subscriber'):
+        self.chart({'secret': 'plop'}).chs('2x2').icac('MY_ACCOUNT_ID').to_binary()
+      self.assertEqual(self.chart({'secret': 'plop'}).chs('2x2').icac('test_fixture').to_binary()[:4], b'\x89PNG')
+
+    def test__serves_scripted_rate_limits(self):
+      self.server.rate_limit(2, retry_after=0.05)
+      start = time.monotonic()
+      self.assertEqual(self.chart({'max_retries': 2}).chs('2x2').to_binary()[:4], b'\x89PNG')
+      self.assertTrue(time.monotonic() - start >= 0.1)
+      self.server.rate_limit(1)
+      with self.assertRaises(ImageChartsRateLimitError) as context:
+        self.chart().chs('2x2').to_binary()
+      self.assertEqual(context.exception.retry_after, '1')
+
+    def test__revalidates_with_etags(self):
+      cache = ChartCache()
+      with MockChartServer(max_age=0) as server:
+        chart = ImageCharts(server.options({'cache': cache})).cht('p').chd('t:1,2,3').chs('3x3')
+        self.assertEqual(chart.to_binary(), chart.to_binary())
+        self.assertEqual(cache.revalidations, 1)
+        self.assertEqual(server.request_count, 2)
+        self.assertTrue(server.last_request[1].get('if-none-match'))
+
+class TestImageChartsRender(unittest.TestCase):
+    def test__returns_an_immutable_response_without_modifying_the_chart(self):
+      session = FakeSession([FakeResponse(200, PNG_BODY, {'content-type': 'image/png', 'etag': '"v1"'})])
+      chart = ImageCharts({'session': session}).cht('p').chd('t:1,2,3').chs('2x2')
+      response = chart.render()
+      self.assertTrue(isinstance(response, ChartResponse))
+      self.assertEqual((response.content, response.mimetype, response.status_code, response.cache, response.retries), (PNG_BODY, 'image/png', 200, None, 0))
+      self.assertEqual(response.headers['etag'], '"v1"')
+      self.assertEqual(response.request_headers['user-agent'], 'python-image-charts/latest')
+      self.assertTrue(response.timings.total >= 0)
+      self.assertTrue(response.to_data_uri().startswith('data:image/png;base64,iVBORw0K'))
+      with self.assertRaises(TypeError):
+        response.headers['etag'] = '"v2"'
+      with self.assertRaises(AttributeError):
+        response.content = b''
+      self.assertEqual((chart.request_headers, chart.response_headers), ({}, {}))
+
+    def test__shares_a_chart_between_threads(self):
+      with MockChartServer(png=PNG_BODY) as server:
+        chart = ImageCharts(server.options({'session': create_session(pool_maxsize=8)})).cht('p').chd('t:1,2,3')
+        def render(index):
+          response = chart.chs('{size}x{size}'.format(size=index % 5 + 1)).render()
+          return response.content, response.headers['etag']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+          results = list(executor.map(render, range(40)))
+      self.assertTrue(all(content == PNG_BODY for content, etag in results))
+      self.assertEqual(len(set(etag for content, etag in results)), 5)
+
+    def test__streams_and_reports_cache_hits(self):
+      session = FakeSession([FakeResponse(200, PNG_BODY, {'cache-control': 'max-age=60'})])
+      chart = ImageCharts({'session': session}).cht('p').chd('t:1,2,3').chs('2x2')
+      response = chart.render(stream=True, chunk_size=10)
+      self.assertEqual([len(chunk) for chunk in response.content][:2], [10, 10])
+      cached = ImageCharts({'session': session, 'cache': ChartCache()}).cht('p').chd('t:1,2,3').chs('2x2')
+      session.responses.append(FakeResponse(200, PNG_BODY, {'cache-control': 'max-age=60'}))
+      self.assertEqual(cached.render().cache, 'miss')
+      hit = cached.render(stream=True)
+      self.assertEqual((hit.cache, hit.status_code, b''.join(hit.content)), ('hit', None, PNG_BODY))
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test__renders_asynchronously(self):
+      with MockChartServer() as server:
+        chart = ImageCharts(server.options()).cht('p').chd('t:1,2,3').chan('100').chs('2x2')
+        response = run_async(chart.render_async())
+      self.assertEqual((response.mimetype, response.status_code), ('image/gif', 200))
+      self.assertTrue(response.to_data_uri().startswith('data:image/gif;base64,R0lGODlh'))
+      self.assertEqual(chart.response_headers, {})
+
+class TestImageChartsSigning(unittest.TestCase):
+    def test__signs_with_a_shared_keyed_state(self):
+      import hmac, hashlib
+      chart = ImageCharts({'secret': 'plop'}).cht('p').chs('100x100').icac('test_fixture')
+      for size in range(3):
+        url = chart.chd('t:{}'.format(size)).to_url()
+        query_string, signature = url.split('?')[1].split('&ichm=')
+        self.assertEqual(signature, hmac.new(b'plop', query_string.encode('utf-8'), hashlib.sha256).hexdigest())
+      self.assertTrue(chart.chd('t:1')._config.signer is chart._config.signer)
+
+    def test__memoizes_a_bounded_number_of_signatures(self):
+      signer = image_charts_module._Signer('plop', size=2)
+      signatures = [signer.sign(query_string) for query_string in ('a=1', 'a=2', 'a=1', 'a=3')]
+      self.assertEqual(signatures[0], signatures[2])
+      self.assertEqual(list(signer._signatures), ['a=1', 'a=3'])
+      self.assertEqual(image_charts_module._Signer('plop', size=0).sign('a=1'), signatures[0])
+
+    def test__bounds_the_size_of_memoized_query_strings(self):
+      import hmac, hashlib
+      signer = image_charts_module._Signer('plop', max_bytes=20000)
+      for i in range(10):
+        signer.sign('chd=t:{}{}'.format(i, ',1' * 5000))
+      signer.sign('chd=t:{}'.format(',1' * 20000))
+      self.assertEqual(list(signer._signatures), ['chd=t:9' + ',1' * 5000])
+      self.assertEqual(signer._bytes, 10007)
+      self.assertEqual(signer.sign('chd=t:' + ',1' * 20000), hmac.new(b'plop', ('chd=t:' + ',1' * 20000).encode('utf-8'), hashlib.sha256).hexdigest())
+
+class TestImageChartsImport(unittest.TestCase):
+    def test__builds_urls_without_importing_the_network_stack(self):
+      script = 'import sys, ImageCharts; ImageCharts.ImageCharts().cht("p").chd("t:1,2,3").chs("2x2").to_url(); ' \
+        'print(sorted(name for name in ("requests", "urllib3", "asyncio", "json", "concurrent.futures", "aiohttp") if name in sys.modules))'
+      output = subprocess.check_output([sys.executable, '-c', script])
+      self.assertEqual(output.decode('utf-8').strip(), '[]')
+
+try:
+  import httpx, h2
+except ImportError:
+  httpx = None
+
+class TestImageChartsTransports(unittest.TestCase):
+    def test__renders_in_process_with_the_fake_transport(self):
+      transport = FakeTransport(accounts={'test_fixture': 'plop'})
+      chart = ImageCharts({'transport': transport, 'secret': 'plop', 'max_retries': 1}).cht('p').chd('t:1,2,3')
+      self.assertEqual(chart.chs('2x2').to_data_uri()[:30], 'data:image/png;base64,iVBORw0K')
+      self.assertEqual(chart.chan('100').chs('2x2').icac('test_fixture').to_data_uri()[:30], 'data:image/gif;base64,R0lGODlh')
+      with self.assertRaisesRegex(ImageChartsValidationError, '"chs" is required'):
+        chart.to_binary()
+      transport.server.rate_limit(1, retry_after=0)
+      path = os.path.join(tempfile.mkdtemp(), 'chart.png')
+      chart.chs('2x2').to_file(path)
+      with open(path, 'rb') as f:
+        self.assertEqual(f.read()[:4], b'\x89PNG')
+      self.assertEqual(transport.server.request_count, 5)
+
+    def test__times_out_with_the_fake_transport(self):
+      chart = ImageCharts({'transport': FakeTransport(latency=1), 'read_timeout': 20}).cht('p').chd('t:1,2,3').chs('2x2')
+      with self.assertRaises(ImageChartsTimeoutError):
+        chart.to_binary()
+
+    def test__accepts_any_object_with_a_get_method(self):
+      class StaticTransport:
+        def get(self, url, headers, timeout, stream=False):
+          return FakeResponse(200, PNG_BODY, {'content-type': 'image/png'})
+      chart = ImageCharts({'transport': StaticTransport()}).cht('p').chd('t:1,2,3').chs('2x2')
+      self.assertEqual(chart.render().content, PNG_BODY)
+      self.assertTrue(isinstance(ImageCharts({'session': FakeSession()}).transport, RequestsTransport))
+
+    @unittest.skipIf(httpx is None, 'httpx[http2] is not installed')
+    def test__renders_with_the_http2_transport(self):
+      transport = HTTP2Transport(max_connections=4)
+      try:
+        with MockChartServer(png=PNG_BODY) as server:
+          chart = ImageCharts(server.options({'transport': transport})).cht('p').chd('t:1,2,3')
+          results = list(ImageCharts.render_many([chart.chs('{size}x{size}'.format(size=size)) for size in range(1, 9)], concurrency=4))
+          self.assertTrue(all(result.content == PNG_BODY for result in results))
+          self.assertEqual(b''.join(chart.chs('2x2').iter_binary(chunk_size=16)), PNG_BODY)
+          with self.assertRaisesRegex(ImageChartsValidationError, '"chs" is required'):
+            chart.to_binary()
+          fresh = HTTP2Transport()
+          options = server.options({'transport': fresh})
+        with self.assertRaises(ImageChartsConnectionError):
+          ImageCharts(options).cht('p').chd('t:1,2,3').chs('2x2').to_binary()
+        fresh.close()
+      finally:
+        transport.close()
+
+class TestImageChartsPost(unittest.TestCase):
+    def large_chart(self, options):
+      labels = '|'.join('label {}'.format(i) for i in range(1000))
+      return ImageCharts(options).cht('p').chs('100x100').chd('t:' + ','.join(str(i) for i in range(1000))).chl(labels)
+
+    def test__posts_charts_whose_url_is_too_long(self):
+      with MockChartServer(png=PNG_BODY, max_url_length=8192) as server:
+        chart = self.large_chart(server.options())
+        self.assertTrue(len(chart.to_url()) > 8192)
+        self.assertEqual(chart.to_binary(), PNG_BODY)
+        self.assertEqual((server.last_request[0], server.last_body), ('/chart', chart.to_url().split('?', 1)[1].encode('ascii')))
+        self.assertEqual(chart.request_headers['content-type'], 'application/x-www-form-urlencoded')
+        with self.assertRaisesRegex(ImageChartsValidationError, 'longer than 8192 characters'):
+          self.large_chart(server.options({'post_threshold': None})).to_binary()
+        self.assertEqual(ImageCharts(server.options()).cht('p').chd('t:1,2,3').chs('2x2').to_binary(), PNG_BODY)
+        self.assertEqual(server.last_body, None)
+
+    def test__signs_post_bodies_like_urls(self):
+      server = MockChartServer(accounts={'test_fixture': 'plop'})
+      for post_format in ('form', 'json'):
+        metrics = MetricsAggregator()
+        chart = self.large_chart({'transport': FakeTransport(server), 'secret': 'plop', 'post_format': post_format, 'hooks': [metrics]}).icac('test_fixture')
+        self.assertEqual(chart.render().status_code, 200)
+        self.assertEqual(metrics.snapshot()['p']['requests'], 1)
+      self.assertEqual(json.loads(server.last_body.decode('utf-8'))['ichm'], chart.to_url().split('&ichm=')[1])
+      with self.assertRaisesRegex(ImageChartsAuthError, 'does not match'):
+        self.large_chart({'transport': FakeTransport(server), 'secret': 'plip'}).icac('test_fixture').to_binary()
+
+    def test__caches_posted_charts_by_url(self):
+      hook = RecordingHook()
+      session = FakeSession([FakeResponse(200, PNG_BODY, {'cache-control': 'max-age=60'})])
+      session.post = session.get
+      chart = self.large_chart({'session': session, 'cache': ChartCache(), 'post_threshold': 100, 'hooks': [hook]})
+      self.assertEqual((chart.render().cache, chart.render().cache), ('miss', 'hit'))
+      self.assertEqual(len(session.calls), 1)
+      event = hook.calls[1][1]
+      self.assertEqual((event['method'], event['url']), ('POST', 'https://image-charts.com:443/chart'))
+      self.assertEqual(session.calls[0][1]['data'], chart.to_url().split('?', 1)[1].encode('ascii'))
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test__posts_asynchronously(self):
+      with MockChartServer(png=PNG_BODY, max_url_length=8192) as server:
+        chart = self.large_chart(server.options({'post_format': 'json'}))
+        self.assertEqual(run_async(chart.to_binary_async()), PNG_BODY)
+      self.assertEqual(json.loads(server.last_body.decode('utf-8'))['cht'], 'p')
+
+    def test__rejects_unknown_post_formats(self):
+      with self.assertRaisesRegex(ValueError, 'post_format'):
+        ImageCharts({'post_format': 'xml'})
+
+class TestImageChartsCLI(unittest.TestCase):
+    def run_cli(self, *argv):
+      stderr = io.StringIO()
+      with contextlib.redirect_stderr(stderr):
+        status = ImageChartsCLI.main(list(argv))
+      return status, stderr.getvalue()
+
+    def write_specs(self, name, content):
+      path = os.path.join(tempfile.mkdtemp(), name)
+      with open(path, 'w') as f:
+        f.write(content)
+      return path
+
+    def test__renders_jsonl_specs_and_skips_up_to_date_outputs(self):
+      specs = self.write_specs('specs.jsonl', '\n'.join(json.dumps({'cht': 'p', 'chd': 't:{}'.format(i), 'chs': '2x2'}) for i in range(5))
+        + '\n' + json.dumps({'cht': 'p', 'chd': 't:1', 'chs': '2x2', 'chan': '100', 'output': 'reports/pie.gif'}) + '\n')
+      output = tempfile.mkdtemp()
+      with MockChartServer(png=PNG_BODY) as server:
+        endpoint = '--endpoint=http://{host}:{port}/chart'.format(host=server.host, port=server.port)
+        status, summary = self.run_cli(specs, '-o', output, '-j', '4', endpoint)
+        self.assertEqual((status, server.request_count), (0, 6))
+        self.assertTrue(summary.startswith('6 rendered, 0 skipped, 0 failed'))
+        self.assertRegex(summary, 'latency p50 \\d+ms, p95 \\d+ms, p99 \\d+ms')
+        with open(os.path.join(output, 'reports', 'pie.gif'), 'rb') as f:
+          self.assertEqual(f.read()[:6], b'GIF89a')
+        self.assertEqual(len([name for name in os.listdir(output) if name.endswith('.png')]), 5)
+        status, summary = self.run_cli(specs, '-o', output, endpoint)
+        self.assertEqual((status, server.request_count), (0, 6))
+        self.assertTrue(summary.startswith('0 rendered, 6 skipped'))
+        self.run_cli(specs, '-o', output, endpoint, '--force')
+        self.assertEqual(server.request_count, 12)
+
+    def test__writes_csv_specs_to_an_archive(self):
+      specs = self.write_specs('specs.csv', 'cht,chd,output\np,t:1,one.png\np,t:2,\n')
+      archive = os.path.join(tempfile.mkdtemp(), 'charts.tar')
+      with MockChartServer(png=PNG_BODY) as server:
+        status, summary = self.run_cli(specs, '--archive', 'tar', '-o', archive, '-p', 'chs=2x2', '--endpoint=http://{host}:{port}/chart'.format(host=server.host, port=server.port))
+      self.assertEqual(status, 0)
+      with tarfile.open(archive) as tar:
+        names = sorted(tar.getnames())
+        self.assertEqual(tar.extractfile('one.png').read(), PNG_BODY)
+      self.assertEqual(len(names), 2)
+      self.assertTrue(names[0].endswith('.png') and names[1] == 'one.png')
+
+    def test__reports_errors_by_code(self):
+      specs = self.write_specs('specs.jsonl', '{"cht": "p", "chd": "t:1"}\n{"cht": "p", "chs": "2x2", "bogus": "1"}\n{"cht": "p", "chd": "t:1", "chs": "2x2"}\n')
+      with MockChartServer() as server:
+        status, summary = self.run_cli(specs, '-o', tempfile.mkdtemp(), '--endpoint=http://{host}:{port}/chart'.format(host=server.host, port=server.port))
+      self.assertEqual(status, 1)
+      self.assertIn('specs.jsonl:1: "chs" is required', summary)
+      self.assertIn('specs.jsonl:2: unknown parameter bogus', summary)
+      self.assertIn('1 rendered, 0 skipped, 2 failed', summary)
+      self.assertIn('1 x IC_VALIDATION_ERROR', summary)
+      status, summary = self.run_cli(self.write_specs('specs.jsonl', '[1, 2]\n'), '-o', tempfile.mkdtemp())
+      self.assertEqual(status, 2)
+      self.assertIn('line 1: expected an object', summary)
+
+    def test__rejects_outputs_outside_the_output_directory(self):
+      directory = tempfile.mkdtemp()
+      output = os.path.join(directory, 'charts')
+      specs = self.write_specs('specs.jsonl', '\n'.join(json.dumps({'cht': 'p', 'chd': 't:1', 'chs': '2x2', 'output': name})
+        for name in ('../escaped.png', os.path.join(directory, 'absolute.png'), 'a/../../escaped.png', 'a/../kept.png')) + '\n')
+      with MockChartServer(png=PNG_BODY) as server:
+        status, summary = self.run_cli(specs, '-o', output, '--endpoint=http://{host}:{port}/chart'.format(host=server.host, port=server.port))
+      self.assertEqual(status, 1)
+      self.assertIn('specs.jsonl:1: output "../escaped.png" is outside the output directory', summary)
+      self.assertIn('1 rendered, 0 skipped, 3 failed', summary)
+      self.assertIn('3 x INVALID_SPEC', summary)
+      self.assertEqual(sorted(os.listdir(directory)), ['charts'])
+      self.assertTrue(os.path.isfile(os.path.join(output, 'kept.png')))
+
+    def test__closes_the_archive_of_unreadable_specs(self):
+      archive = os.path.join(tempfile.mkdtemp(), 'charts.tar')
+      status, summary = self.run_cli(self.write_specs('specs.jsonl', '{"cht": \n'), '--archive', 'tar', '-o', archive)
+      self.assertEqual(status, 2)
+      self.assertIn('invalid JSON', summary)
+      with tarfile.open(archive) as tar:
+        self.assertEqual(tar.getnames(), [])
+
+    def test__computes_nearest_rank_percentiles(self):
+      values = list(range(1, 101))
+      self.assertEqual([ImageChartsCLI.percentile(values, rank) for rank in (50, 95, 99, 100)], [50, 95, 99, 100])
+      self.assertEqual(ImageChartsCLI.percentile([1, 2, 3, 4], 50), 2)
+      self.assertEqual(ImageChartsCLI.percentile([1, 2, 3, 4], 99), 4)
+      self.assertEqual(ImageChartsCLI.percentile([7], 0), 7)
+      self.assertEqual(ImageChartsCLI.percentile([], 50), None)
+
+class TestImageChartsPickling(unittest.TestCase):
+    def test__pickles_charts_as_a_config_handle_and_parameter_pairs(self):
+      metrics = MetricsAggregator()
+      base = ImageCharts({'secret': 'plop', 'hooks': [metrics], 'max_retries': 3}).cht('p').chs('2x2').icac('test_fixture')
+      charts = [base.chd('t:{}'.format(i)) for i in range(10)]
+      charts[0].request_headers = {'user-agent': 'not sent'}
+      restored = pickle.loads(pickle.dumps(charts))
+      self.assertEqual([chart.to_url() for chart in restored], [chart.to_url() for chart in charts])
+      self.assertTrue(all(chart._config is base._config for chart in restored))
+      self.assertEqual(restored[0].request_headers, {})
+      self.assertTrue(len(pickle.dumps(charts[1])) < 400)
+      self.assertTrue(isinstance(base.handle, ConfigHandle) and base.handle is charts[1].handle)
+      self.assertEqual(ImageCharts(base.handle).cht('p')._config, base._config)
+
+    def test__rebuilds_one_config_per_process_from_a_handle(self):
+      base = ImageCharts({'secret': 'plop', 'hooks': [MetricsAggregator()], 'cache': ChartCache(memory_bytes=10), 'max_retries': 3}).cht('p').icac('test_fixture')
+      data = pickle.dumps([base.chd('t:1'), base.chd('t:2')])
+      local_configs = image_charts_module._local_configs
+      image_charts_module._local_configs = {}
+      try:
+        first, second = pickle.loads(data)
+        third = pickle.loads(pickle.dumps(base.chd('t:3')))
+      finally:
+        image_charts_module._local_configs = local_configs
+      self.assertTrue(first._config is second._config is third._config)
+      self.assertTrue(first._config is not base._config)
+      self.assertEqual((first._config.max_retries, first._config.hooks, first._config.cache.memory_bytes), (3, (), 10))
+      self.assertEqual(first.to_url(), base.chd('t:1').to_url())
+
+    def test__shares_and_bounds_the_configs_rebuilt_from_handles(self):
+      charts = [ImageCharts({'secret': 'plop', 'max_retries': 3}).cht('p').chd('t:{}'.format(i)) for i in range(200)]
+      others = [ImageCharts({'max_retries': i}).cht('p') for i in range(200)]
+      data = pickle.dumps((charts, others))
+      local_configs = image_charts_module._local_configs
+      image_charts_module._local_configs = {}
+      try:
+        charts, others = pickle.loads(data)
+      finally:
+        image_charts_module._local_configs = local_configs
+      self.assertEqual(len(set(id(chart._config) for chart in charts)), 1)
+      self.assertEqual(len(image_charts_module._wire_configs), image_charts_module.WIRE_CONFIGS_SIZE)
+      self.assertEqual(others[-1]._config.max_retries, 199)
+
+    def test__renders_pickled_charts_in_spawned_processes(self):
+      base = ImageCharts({'secret': 'plop'}).cht('p').chs('2x2').icac('test_fixture')
+      charts = [base.chd('t:{}'.format(i)) for i in range(4)]
+      from concurrent.futures import ProcessPoolExecutor
+      with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        self.assertEqual(list(executor.map(operator.methodcaller('to_url'), charts)), [chart.to_url() for chart in charts])
+
+    def test__rejects_unknown_wire_versions(self):
+      with self.assertRaisesRegex(ValueError, 'wire format version 2'):
+        image_charts_module._chart_from_wire(2, ImageCharts().handle, ())
+
+class TestImageChartsDataSeries(unittest.TestCase):
+    def test__appends_and_evicts_like_encoding_the_window(self):
+      values = [5, 3.5, None, 8, float('nan'), -2, 7, 7, 1, 9, 0.25]
+      for encoding, options in (('t', {}), ('a', {'precision': 1}), ('s', {'scale': (-2, 9)}), ('e', {'scale': (-2, 9)})):
+        series = ImageChartsData.DataSeries(encoding=encoding, maxlen=4, **options)
+        for index, value in enumerate(values):
+          series.append(value)
+          window = values[max(0, index - 3):index + 1]
+          self.assertEqual(series.chd(), ImageChartsData.encode(window, encoding, precision=options.get('precision'), scale=options.get('scale')))
+          self.assertEqual(series.chds(), ImageChartsData.chds(window))
+        self.assertEqual(len(series), 4)
+
+    def test__pickles_charts_built_from_a_series(self):
+      chd = ImageChartsData.DataSeries([1, 2, 3]).chd()
+      chart = ImageCharts().cht('lc').chs('10x10').chd(chd)
+      copy = pickle.loads(pickle.dumps(chart))
+      self.assertEqual(copy.to_url(), chart.to_url())
+      data = pickle.loads(pickle.dumps(chd))
+      self.assertEqual((type(data), data, data.quoted), (type(chd), chd, chd.quoted))
+
+    def test__joins_several_series(self):
+      first, second = ImageChartsData.DataSeries([1, 2, 3]), ImageChartsData.DataSeries([None, 50])
+      self.assertEqual(ImageChartsData.series_chd([first, second]), ImageChartsData.encode([[1, 2, 3], [None, 50]], 't'))
+      self.assertEqual(ImageChartsData.series_chds([first, second]), '1,50')
+      self.assertEqual(ImageChartsData.series_chds([first, second], per_series=True), '1,3,50,50')
+      second.evict(2)
+      self.assertEqual((second.chd(), second.chds()), ('t:', '0,0'))
+      with self.assertRaisesRegex(ValueError, 'share one encoding'):
+        ImageChartsData.series_chd([first, ImageChartsData.DataSeries(encoding='s', scale=(0, 1))])
+      with self.assertRaisesRegex(ValueError, 'fixed scale'):
+        ImageChartsData.DataSeries(encoding='e')
+
+    def test__urls_use_the_encoded_form_of_series(self):
+      series = ImageChartsData.DataSeries([1.5, -2, 1e-07, 1e+22, None], encoding='a')
+      base = ImageCharts({'secret': 'plop'}).cht('lc').chs('10x10').icac('test_fixture')
+      expected = base.chd(str(series.chd())).chds(series.chds()).to_url()
+      self.assertEqual(base.chd(series.chd()).chds(series.chds()).to_url(), expected)
+      self.assertEqual(ChartTemplate(base).to_url(chd=series.chd(), chds=series.chds()), expected)
+      with MockChartServer() as server:
+        self.assertEqual(ImageCharts(server.options()).cht('lc').chs('10x10').chd(series.chd()).render().status_code, 200)
+
 if __name__ == '__main__':
   unittest.main()
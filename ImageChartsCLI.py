@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+# Compatible with Python 3.6+
+
+"""Render batches of charts described in JSONL or CSV files, from the command line
+
+  $ image-charts specs.jsonl -o charts/ -j 16
+  $ cat specs.csv | image-charts --format csv --archive tar -o - > charts.tar
+
+Each JSONL line is an object of chart parameters, each CSV row holds one parameter per column (empty
+cells are ignored). The optional "output" key or column names the output file (relative to the output, specs escaping it fail), charts are otherwise
+named after the digest of their url. Rendered directories keep a manifest of the url of each file,
+so charts whose output is up to date are skipped on the next run.
+
+A summary (throughput, latency percentiles, bytes and errors by x-ic-error-code) is printed to stderr,
+the exit status is 1 when a chart failed.
+"""
+
+import argparse, csv, hashlib, io, json, math, os, sys, threading, time
+
+from ImageCharts import ImageCharts, ImageChartsError, ChartTemplate, DEFAULT_POST_THRESHOLD
+
+MANIFEST = '.image-charts-manifest.json'
+
+# parameter methods of ImageCharts, spec keys are checked against them
+PARAMETERS = frozenset(name for name in vars(ImageCharts) if name.startswith(('ch', 'ic')) and callable(vars(ImageCharts)[name]))
+
+class SpecError(ValueError):
+  pass
+
+def read_specs(f, spec_format):
+  """Yield (line number, parameters) for each spec of the text file f, spec_format being jsonl or csv"""
+  if spec_format == 'csv':
+    # the header is line 1
+    for line_number, row in enumerate(csv.DictReader(f), 2):
+      yield line_number, {key.strip(): value for key, value in row.items() if key and value not in (None, '')}
+    return
+
+  for line_number, line in enumerate(f, 1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      spec = json.loads(line)
+    except ValueError as error:
+      raise SpecError('line {line_number}: invalid JSON, {error}'.format(line_number=line_number, error=error))
+    if not isinstance(spec, dict):
+      raise SpecError('line {line_number}: expected an object of chart parameters'.format(line_number=line_number))
+    yield line_number, spec
+
+def output_name(params, url):
+  """Default file name of a chart, the digest of its url and the extension of its format"""
+  if 'chan' in params:
+    extension = '.gif'
+  elif params.get('chof') in ('.svg', '.gif'):
+    extension = params['chof']
+  else:
+    extension = '.png'
+  return _digest(url)[:20] + extension
+
+def percentile(values, rank):
+  """Nearest-rank percentile of sorted values, None when there is none"""
+  if not values:
+    return None
+  return values[min(len(values) - 1, max(0, math.ceil(rank / 100.0 * len(values)) - 1))]
+
+class Summary:
+  """Hook collecting the latency, bytes and error code of every chart download"""
+
+  def __init__(self) -> None:
+    self.latencies = []
+    self.bytes = 0
+    self.errors = {}
+    self._lock = threading.Lock()
+
+  def after_response(self, event):
+    with self._lock:
+      self.latencies.append(event['timings']['total'])
+      self.bytes += event['bytes']
+
+  def on_error(self, event):
+    error = event['error']
+    self.count_error(error.error_code if isinstance(error, ImageChartsError) and error.error_code else type(error).__name__)
+
+  def count_error(self, error_code):
+    with self._lock:
+      self.errors[error_code] = self.errors.get(error_code, 0) + 1
+
+  def format(self, rendered, skipped, failed, elapsed):
+    latencies = sorted(self.latencies)
+
+    def ms(value):
+      return '-' if value is None else '{:.0f}ms'.format(value * 1000)
+
+    lines = [
+      '{rendered} rendered, {skipped} skipped, {failed} failed in {elapsed:.2f}s ({rate:.1f} charts/s)'.format(
+        rendered=rendered, skipped=skipped, failed=failed, elapsed=elapsed, rate=rendered / elapsed if elapsed > 0 else 0.0),
+      'latency p50 {p50}, p95 {p95}, p99 {p99}, {bytes} bytes downloaded'.format(
+        p50=ms(percentile(latencies, 50)), p95=ms(percentile(latencies, 95)), p99=ms(percentile(latencies, 99)), bytes=self.bytes)
+    ]
+    for error_code, count in sorted(self.errors.items(), key=lambda item: (-item[1], item[0])):
+      lines.append('{count} x {error_code}'.format(count=count, error_code=error_code))
+    return '\n'.join(lines)
+
+class DirectoryOutput:
+  """Write charts to a directory, atomically, and remember the url of each one in a manifest"""
+
+  def __init__(self, path) -> None:
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+    try:
+      with open(os.path.join(path, MANIFEST)) as f:
+        self.manifest = json.load(f)
+    except (OSError, ValueError):
+      self.manifest = {}
+
+  def is_up_to_date(self, name, url):
+    return self.manifest.get(name) == _digest(url) and os.path.isfile(os.path.join(self.path, name))
+
+  def write(self, name, url, content):
+    path = os.path.join(self.path, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _atomic_write(path, content)
+    self.manifest[name] = _digest(url)
+
+  def close(self):
+    _atomic_write(os.path.join(self.path, MANIFEST), json.dumps(self.manifest, sort_keys=True).encode('utf-8'))
+
+class ArchiveOutput:
+  """Write charts to a tar or zip stream (a file, or stdout for "-")"""
+
+  def __init__(self, path, archive_format) -> None:
+    self._file = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    if archive_format == 'zip':
+      import zipfile
+      self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_STORED)
+      self._tar = None
+    else:
+      import tarfile
+      self._tar = tarfile.open(fileobj=self._file, mode='w|gz' if archive_format == 'tgz' else 'w|')
+      self._zip = None
+
+  def is_up_to_date(self, name, url):
+    return False
+
+  def write(self, name, url, content):
+    if self._zip is not None:
+      self._zip.writestr(name, content)
+      return
+    import tarfile
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = int(time.time())
+    self._tar.addfile(info, io.BytesIO(content))
+
+  def close(self):
+    (self._zip if self._zip is not None else self._tar).close()
+    if self._file is not sys.stdout.buffer:
+      self._file.close()
+    else:
+      self._file.flush()
+
+def _digest(url):
+  return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def _is_relative_name(name):
+  # output names stay inside the output directory (or archive)
+  normalized = os.path.normpath(name)
+  return not (os.path.isabs(name) or os.path.splitdrive(name)[0] or normalized == os.pardir or normalized.startswith(os.pardir + os.sep))
+
+def _atomic_write(path, content):
+  tmp_path = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(content)
+  os.replace(tmp_path, path)
+
+def _parse_param(value):
+  param, separator, param_value = value.partition('=')
+  if not separator:
+    raise argparse.ArgumentTypeError('expected PARAM=VALUE, got "{value}"'.format(value=value))
+  return param, param_value
+
+def _options(args, hooks):
+  from urllib.parse import urlsplit
+
+  endpoint = urlsplit(args.endpoint)
+  options = {
+    'protocol': endpoint.scheme,
+    'host': endpoint.hostname,
+    'port': endpoint.port or (443 if endpoint.scheme == 'https' else 80),
+    'pathname': endpoint.path or '/chart',
+    'timeout': args.timeout,
+    'max_retries': args.retries,
+    'post_threshold': args.post_threshold,
+    'hooks': hooks
+  }
+  secret = args.secret if args.secret is not None else os.environ.get('IMAGE_CHARTS_SECRET')
+  if secret:
+    options['secret'] = secret
+  return options
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(prog='image-charts', description='Render batches of Image-Charts charts described in JSONL or CSV files.')
+  parser.add_argument('inputs', nargs='*', default=['-'], metavar='SPECS', help='JSONL or CSV chart specs, "-" (default) reads stdin')
+  parser.add_argument('-f', '--format', choices=('jsonl', 'csv'), help='format of the specs, guessed from the file extension (jsonl for stdin)')
+  parser.add_argument('-o', '--output', default='.', help='output directory, or archive file ("-" for stdout) with --archive')
+  parser.add_argument('-a', '--archive', choices=('tar', 'tgz', 'zip'), help='write a tar, gzipped tar or zip archive instead of a directory')
+  parser.add_argument('-j', '--workers', type=int, default=8, help='number of simultaneous downloads (default: 8)')
+  parser.add_argument('-p', '--param', type=_parse_param, action='append', default=[], metavar='PARAM=VALUE', help='parameter of every chart, specs override it')
+  parser.add_argument('--force', action='store_true', help='render charts even when their output is up to date')
+  parser.add_argument('--endpoint', default='https://image-charts.com/chart', help='chart endpoint url (default: https://image-charts.com/chart)')
+  parser.add_argument('--secret', help='enterprise secret key signing charts with icac, defaults to $IMAGE_CHARTS_SECRET')
+  parser.add_argument('--timeout', type=int, default=5000, help='request timeout in milliseconds (default: 5000)')
+  parser.add_argument('--retries', type=int, default=2, help='retries of rate limited, failed or timed out downloads (default: 2)')
+  parser.add_argument('--rate-limit', type=float, help='maximum number of requests per second')
+  parser.add_argument('--post-threshold', type=int, default=DEFAULT_POST_THRESHOLD, help='url length above which charts are sent with POST')
+  parser.add_argument('-q', '--quiet', action='store_true', help='do not report each failed chart')
+  return parser.parse_args(argv)
+
+def _open_specs(path, spec_format):
+  if spec_format is None:
+    spec_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+  f = sys.stdin if path == '-' else open(path, newline='' if spec_format == 'csv' else None, encoding='utf-8')
+  return f, spec_format
+
+def _charts(args, template, output, summary, skipped, failures):
+  # yield (chart, name, url) of every spec to render, up to date and invalid specs are counted as they are read
+  defaults = dict(args.param)
+  for path in args.inputs:
+    f, spec_format = _open_specs(path, args.format)
+    try:
+      for line_number, spec in read_specs(f, spec_format):
+        params = dict(defaults, **spec)
+        name = params.pop('output', None)
+        unknown = sorted(param for param in params if param not in PARAMETERS)
+        if unknown:
+          failures.append('{path}:{line_number}: unknown parameter {params}'.format(path=path, line_number=line_number, params=', '.join(unknown)))
+          summary.count_error('INVALID_SPEC')
+          continue
+        if name and not _is_relative_name(str(name)):
+          failures.append('{path}:{line_number}: output "{name}" is outside the output directory'.format(path=path, line_number=line_number, name=name))
+          summary.count_error('INVALID_SPEC')
+          continue
+        chart = template.chart_with({param: str(value) for param, value in params.items()})
+        url = chart.to_url()
+        name = str(name) if name else output_name(params, url)
+        if not args.force and output.is_up_to_date(name, url):
+          skipped.append(name)
+          continue
+        yield chart, name, url, '{path}:{line_number}'.format(path=path, line_number=line_number)
+    except SpecError as error:
+      raise SpecError('{path}: {error}'.format(path=path, error=error)) from error
+    finally:
+      if f is not sys.stdin:
+        f.close()
+
+def main(argv=None):
+  """Entry point of the image-charts command, return the exit status"""
+  args = parse_args(argv)
+  summary = Summary()
+  template = ChartTemplate(ImageCharts(_options(args, [summary])))
+  output = ArchiveOutput(args.output, args.archive) if args.archive else DirectoryOutput(args.output)
+
+  started = time.perf_counter()
+  skipped, failures = [], []
+  rendered = 0
+  try:
+    jobs = list(_charts(args, template, output, summary, skipped, failures))
+  except (OSError, SpecError) as error:
+    output.close()
+    print('image-charts: {error}'.format(error=error), file=sys.stderr)
+    return 2
+
+  results = ImageCharts.render_many([chart for chart, name, url, location in jobs], concurrency=args.workers, ordered=False, rate_limit=args.rate_limit)
+  try:
+    for result in results:
+      chart, name, url, location = jobs[result.index]
+      if result.error is not None:
+        failures.append('{location}: {error}'.format(location=location, error=result.error))
+        continue
+      output.write(name, url, result.content)
+      rendered += 1
+  finally:
+    output.close()
+
+  if not args.quiet:
+    for failure in failures:
+      print(failure, file=sys.stderr)
+  print(summary.format(rendered, len(skipped), len(failures), time.perf_counter() - started), file=sys.stderr)
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
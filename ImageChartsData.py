@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+# Compatible with Python 3.6+
+
+"""Chart data (chd) encoders for image-charts.com
+
+Accept lists, array.array or NumPy arrays (vectorized when NumPy is available) and emit
+text (t:), auto-scaled (a:), simple (s:) and extended (e:) encoded chart data.
+
+DataSeries keeps the encoded form of a live series, so appending a point does not re-encode the others.
+"""
+
+import math
+from collections import deque
+from urllib.parse import quote_plus
+
+SIMPLE_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+EXTENDED_CHARS = SIMPLE_CHARS + '-.'
+
+_SIMPLE_MAX = len(SIMPLE_CHARS) - 1
+_EXTENDED_MAX = len(EXTENDED_CHARS) ** 2 - 1
+_EXTENDED_PAIRS = [high + low for high in EXTENDED_CHARS for low in EXTENDED_CHARS]
+
+_SEPARATORS = {'t': '|', 'a': '|', 's': ',', 'e': ','}
+
+
+def _is_numpy(values):
+  return type(values).__module__ == 'numpy'
+
+def _is_missing(value):
+  return value is None or (isinstance(value, float) and math.isnan(value))
+
+def _as_series_list(data):
+  """Normalize one series or a list of series to a list of series"""
+  if _is_numpy(data):
+    return list(data) if data.ndim == 2 else [data]
+  if isinstance(data, (list, tuple)) and len(data) > 0 and not isinstance(data[0], (int, float)) and data[0] is not None and hasattr(data[0], '__len__'):
+    return list(data)
+  return [data]
+
+def chs_width(chs):
+  """Width in pixels of a chs value (<width>x<height>)"""
+  return int(str(chs).lower().split('x')[0])
+
+def data_range(data):
+  """(min, max) of every value of one series or a list of series, missing values (None, NaN) excluded"""
+  low, high = math.inf, -math.inf
+  for series in _as_series_list(data):
+    if _is_numpy(series):
+      import numpy
+      if len(series) == 0 or numpy.isnan(series).all():
+        continue
+      low, high = min(low, float(numpy.nanmin(series))), max(high, float(numpy.nanmax(series)))
+    else:
+      values = [value for value in series if not _is_missing(value)]
+      if values:
+        low, high = min(low, min(values)), max(high, max(values))
+  return (0, 0) if low > high else (low, high)
+
+def chds(data, per_series=False):
+  """chds value scaling text encoded data to its range, either one global range or one range per series"""
+  ranges = [data_range(series) for series in _as_series_list(data)] if per_series else [data_range(data)]
+  return ','.join(_format_number(value) for pair in ranges for value in pair)
+
+def downsample(values, width, method='minmax'):
+  """Reduce a series to about width points, missing values are dropped
+
+  - method :str - 'minmax' keeps the minimum and maximum of width / 2 buckets (preserves spikes),
+    'lttb' applies the Largest-Triangle-Three-Buckets algorithm (preserves the visual shape)
+  """
+  if method not in ('minmax', 'lttb'):
+    raise ValueError('unknown downsampling method "{method}"'.format(method=method))
+
+  if _is_numpy(values):
+    import numpy
+    values = values[~numpy.isnan(values)] if values.dtype.kind == 'f' else values
+  else:
+    values = [value for value in values if not _is_missing(value)]
+
+  if len(values) <= width or width < 3:
+    return values
+  return _minmax(values, width) if method == 'minmax' else _lttb(values, width)
+
+def _bucket_edges(size, buckets):
+  return [size * index // buckets for index in range(buckets + 1)]
+
+def _minmax(values, width):
+  edges = _bucket_edges(len(values), width // 2)
+  numpy_values = _is_numpy(values)
+  sampled = []
+  for start, end in zip(edges, edges[1:]):
+    bucket = values[start:end]
+    if numpy_values:
+      low, high = int(bucket.argmin()), int(bucket.argmax())
+    else:
+      low = min(range(len(bucket)), key=bucket.__getitem__)
+      high = max(range(len(bucket)), key=bucket.__getitem__)
+    for index in sorted({low, high}):
+      sampled.append(bucket[index])
+  if numpy_values:
+    import numpy
+    return numpy.array(sampled, dtype=values.dtype)
+  return sampled
+
+def _lttb(values, width):
+  # first and last points are kept, the others are split in width - 2 buckets
+  edges = _bucket_edges(len(values) - 2, width - 2)
+  numpy_values = _is_numpy(values)
+  if numpy_values:
+    import numpy
+    ys = values.astype(float)
+  sampled = [values[0]]
+  previous_x, previous_y = 0, float(values[0])
+  for bucket in range(width - 2):
+    start, end = edges[bucket] + 1, edges[bucket + 1] + 1
+    next_start, next_end = end, (edges[bucket + 2] + 1 if bucket + 2 < len(edges) else len(values))
+    if numpy_values:
+      average_x = (next_start + next_end - 1) / 2.0
+      average_y = float(ys[next_start:next_end].mean())
+      xs = numpy.arange(start, end)
+      areas = numpy.abs((previous_x - average_x) * (ys[start:end] - previous_y) - (previous_x - xs) * (average_y - previous_y))
+      selected = start + int(areas.argmax())
+    else:
+      average_x = (next_start + next_end - 1) / 2.0
+      average_y = sum(values[next_start:next_end]) / float(next_end - next_start)
+      selected, best = start, -1.0
+      for x in range(start, end):
+        area = abs((previous_x - average_x) * (values[x] - previous_y) - (previous_x - x) * (average_y - previous_y))
+        if area > best:
+          selected, best = x, area
+    sampled.append(values[selected])
+    previous_x, previous_y = selected, float(values[selected])
+  sampled.append(values[-1])
+  if numpy_values:
+    return numpy.array(sampled, dtype=values.dtype)
+  return sampled
+
+def _format_number(value):
+  if isinstance(value, float):
+    return str(int(value)) if value.is_integer() else repr(float(value))
+  return str(value)
+
+def _encode_text_series(values, precision):
+  if _is_numpy(values):
+    import numpy
+    if values.dtype.kind == 'b':
+      values = values.astype(numpy.int64)
+    if values.dtype.kind in 'iu':
+      return ','.join(map(str, values.tolist()))
+    values = values.astype(float)
+    if precision is not None:
+      values = numpy.round(values, precision)
+    missing = numpy.isnan(values)
+    if not missing.any() and (values == numpy.floor(values)).all() and (numpy.abs(values) < 2 ** 53).all():
+      return ','.join(map(str, values.astype(numpy.int64).tolist()))
+    values = [None if is_missing else value for value, is_missing in zip(values.tolist(), missing.tolist())]
+  elif precision is not None:
+    values = [value if _is_missing(value) else round(value, precision) for value in values]
+  return ','.join('_' if _is_missing(value) else _format_number(value) for value in values)
+
+def _scaled_indexes(values, low, high, maximum):
+  """Scale values to integer indexes in [0, maximum], missing values are None (or masked in NumPy)"""
+  span = float(high - low)
+  if _is_numpy(values):
+    import numpy
+    values = values.astype(float)
+    missing = numpy.isnan(values)
+    scaled = numpy.zeros(len(values)) if span == 0 else numpy.rint((numpy.where(missing, low, values) - low) * (maximum / span))
+    return numpy.clip(scaled, 0, maximum).astype(numpy.intp), missing
+  factor = 0 if span == 0 else maximum / span
+  return [None if _is_missing(value) else min(maximum, max(0, int(round((value - low) * factor)))) for value in values], None
+
+def _encode_simple_series(values, low, high):
+  indexes, missing = _scaled_indexes(values, low, high, _SIMPLE_MAX)
+  if missing is not None:
+    import numpy
+    encoded = numpy.frombuffer(SIMPLE_CHARS.encode('ascii'), dtype=numpy.uint8)[indexes]
+    encoded[missing] = ord('_')
+    return encoded.tobytes().decode('ascii')
+  return ''.join('_' if index is None else SIMPLE_CHARS[index] for index in indexes)
+
+def _encode_extended_series(values, low, high):
+  indexes, missing = _scaled_indexes(values, low, high, _EXTENDED_MAX)
+  if missing is not None:
+    import numpy
+    table = numpy.frombuffer(EXTENDED_CHARS.encode('ascii'), dtype=numpy.uint8)
+    encoded = numpy.empty((len(indexes), 2), dtype=numpy.uint8)
+    encoded[:, 0] = table[indexes // len(EXTENDED_CHARS)]
+    encoded[:, 1] = table[indexes % len(EXTENDED_CHARS)]
+    encoded[missing] = ord('_')
+    return encoded.tobytes().decode('ascii')
+  return ''.join('__' if index is None else _EXTENDED_PAIRS[index] for index in indexes)
+
+def encode(data, encoding='a', precision=None, scale=None, width=None, chs=None, downsampling='minmax'):
+  """Encode one series or a list of series to a chd value
+
+  - data :list|array.array|numpy.ndarray - one series or a list of series (or a 2D array), None and NaN are missing values
+  - encoding :str - 't' text, 'a' auto-scaled text, 's' simple or 'e' extended encoding
+  - precision :int - number of decimals kept by text encodings
+  - scale :tuple - (min, max) range mapped by simple and extended encodings, defaults to the range of data
+  - width :int - downsample series longer than width points
+  - chs :str - chart size, its width is used when width is not defined
+  - downsampling :str - 'minmax' or 'lttb', see downsample()
+  """
+  if encoding not in _SEPARATORS:
+    raise ValueError('unknown encoding "{encoding}", expected one of t, a, s or e'.format(encoding=encoding))
+
+  series_list = _as_series_list(data)
+  if width is None and chs is not None:
+    width = chs_width(chs)
+  if width is not None:
+    series_list = [downsample(series, width, downsampling) for series in series_list]
+
+  if encoding in ('t', 'a'):
+    encoded = [_encode_text_series(series, precision) for series in series_list]
+  else:
+    low, high = scale if scale is not None else data_range(series_list)
+    encode_series = _encode_simple_series if encoding == 's' else _encode_extended_series
+    encoded = [encode_series(series, low, high) for series in series_list]
+
+  return encoding + ':' + _SEPARATORS[encoding].join(encoded)
+
+
+class ChartData(str):
+  """chd value carrying its url encoded form, ImageCharts.to_url() and ChartTemplate use it instead of encoding it again"""
+
+  __slots__ = ('quoted',)
+
+  def __new__(cls, value, quoted):
+    data = super().__new__(cls, value)
+    data.quoted = quoted
+    return data
+
+  def __reduce__(self):
+    return (ChartData, (str(self), self.quoted))
+
+class DataSeries:
+  """Series of chart data keeping the encoded token of each value, for charts redrawn as points arrive
+
+  Appending and evicting points cost O(1) amortized: tokens are encoded once, the range of the window used by chds()
+  is tracked with monotonic deques. chd() joins the tokens (and their url encoded form) once per change.
+
+  - values :iterable - initial values, None and NaN are missing values
+  - encoding :str - 't' text, 'a' auto-scaled text, 's' simple or 'e' extended encoding
+  - maxlen :int - sliding window size, the oldest points are evicted beyond it (None keeps every point)
+  - precision :int - number of decimals kept by text encodings
+  - scale :tuple - (min, max) range mapped by simple and extended encodings, required by them since
+    a range following the data would change every token
+  """
+
+  def __init__(self, values=(), encoding='t', maxlen=None, precision=None, scale=None) -> None:
+    if encoding not in _SEPARATORS:
+      raise ValueError('unknown encoding "{encoding}", expected one of t, a, s or e'.format(encoding=encoding))
+    if encoding in ('s', 'e') and scale is None:
+      raise ValueError('simple and extended encoded series require a fixed scale (min, max)')
+    self.encoding = encoding
+    self.maxlen = maxlen
+    self.precision = precision
+    self.scale = scale
+    self._values = deque()
+    self._tokens = deque()
+    self._quoted_tokens = deque()
+    # (index, value) candidates for the minimum and the maximum of the window
+    self._minimums = deque()
+    self._maximums = deque()
+    self._next_index = 0
+    self._body = None
+    self.extend(values)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def append(self, value):
+    """Add a point at the end of the series, evicting the oldest one beyond maxlen"""
+    token = self._token(value)
+    self._values.append(value)
+    self._tokens.append(token)
+    self._quoted_tokens.append(quote_plus(token))
+    if not _is_missing(value):
+      index = self._next_index
+      while self._minimums and self._minimums[-1][1] >= value:
+        self._minimums.pop()
+      self._minimums.append((index, value))
+      while self._maximums and self._maximums[-1][1] <= value:
+        self._maximums.pop()
+      self._maximums.append((index, value))
+    self._next_index += 1
+    self._body = None
+    if self.maxlen is not None and len(self._values) > self.maxlen:
+      self.evict()
+
+  def extend(self, values):
+    for value in values:
+      self.append(value)
+
+  def evict(self, count=1):
+    """Remove the count oldest points"""
+    for _ in range(min(count, len(self._values))):
+      index = self._next_index - len(self._values)
+      self._values.popleft()
+      self._tokens.popleft()
+      self._quoted_tokens.popleft()
+      if self._minimums and self._minimums[0][0] == index:
+        self._minimums.popleft()
+      if self._maximums and self._maximums[0][0] == index:
+        self._maximums.popleft()
+      self._body = None
+
+  def data_range(self):
+    """(min, max) of the values of the window, missing values excluded"""
+    if not self._minimums:
+      return (0, 0)
+    return (self._minimums[0][1], self._maximums[0][1])
+
+  def chds(self):
+    """chds value scaling the text encoded series to the range of its window"""
+    return ','.join(_format_number(value) for value in self.data_range())
+
+  def chd(self):
+    """chd value of the series"""
+    body, quoted_body = self._encoded()
+    return ChartData(self.encoding + ':' + body, self.encoding + '%3A' + quoted_body)
+
+  def _encoded(self):
+    # tokens and url encoded tokens joined by the separator of the encoding, cached until the series changes
+    if self._body is None:
+      separator = ',' if self.encoding in ('t', 'a') else ''
+      self._body = (separator.join(self._tokens), quote_plus(separator).join(self._quoted_tokens))
+    return self._body
+
+  def _token(self, value):
+    if self.encoding in ('t', 'a'):
+      if _is_missing(value):
+        return '_'
+      return _format_number(value if self.precision is None else round(value, self.precision))
+    if _is_missing(value):
+      return '_' if self.encoding == 's' else '__'
+    low, high = self.scale
+    maximum = _SIMPLE_MAX if self.encoding == 's' else _EXTENDED_MAX
+    index = 0 if high == low else min(maximum, max(0, int(round((value - low) * (maximum / float(high - low))))))
+    return SIMPLE_CHARS[index] if self.encoding == 's' else _EXTENDED_PAIRS[index]
+
+def series_chd(series_list):
+  """chd value of several DataSeries sharing the same encoding"""
+  encodings = set(series.encoding for series in series_list)
+  if len(encodings) != 1:
+    raise ValueError('series must share one encoding, got {encodings}'.format(encodings=', '.join(sorted(encodings)) or 'none'))
+  encoding = encodings.pop()
+  separator = _SEPARATORS[encoding]
+  bodies = [series._encoded() for series in series_list]
+  return ChartData(encoding + ':' + separator.join(body for body, quoted in bodies),
+    encoding + '%3A' + quote_plus(separator).join(quoted for body, quoted in bodies))
+
+def series_chds(series_list, per_series=False):
+  """chds value scaling several text encoded DataSeries to their window, one global range or one range per series"""
+  if per_series:
+    ranges = [series.data_range() for series in series_list]
+  else:
+    ranges = [series.data_range() for series in series_list if series._minimums]
+    ranges = [(min(low for low, high in ranges), max(high for low, high in ranges))] if ranges else [(0, 0)]
+  return ','.join(_format_number(value) for pair in ranges for value in pair)
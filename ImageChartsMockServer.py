@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# Compatible with Python 3.6+
+
+"""Local stand-in for the image-charts.com /chart endpoint, to test and benchmark clients offline
+
+  with MockChartServer(latency=0.05) as server:
+    ImageCharts(server.options()).cht('p').chd('t:1,2,3').chs('100x100').to_binary()
+
+Charts are validated like Image-Charts does (x-ic-error-code and x-ic-error-validation headers), icac
+requests are checked against the signature of the configured accounts, and scripted responses
+(429 with Retry-After, 5xx...) can be queued to exercise retries. Charts are read from the query string
+of GET requests or from the form or JSON body of POST requests.
+
+FakeTransport gives the same answers in-process, without any socket:
+
+  ImageCharts({'transport': FakeTransport(latency=0.05)}).cht('p').chd('t:1,2,3').chs('100x100').to_binary()
+"""
+
+import hashlib, hmac, json, struct, threading, time, zlib
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl, quote_plus
+
+from ImageCharts import validate_query, ImageChartsTimeoutError
+
+def _png_chunk(kind, data):
+  return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+# 1x1 transparent PNG and GIF images
+PNG = b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0)) \
+  + _png_chunk(b'IDAT', zlib.compress(b'\x00\x00\x00\x00\x00')) + _png_chunk(b'IEND', b'')
+GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class _MockChartHandler(BaseHTTPRequestHandler):
+  # keep-alive, so pooled clients can be told apart from one connection per request
+  protocol_version = 'HTTP/1.1'
+  # headers and body are written separately, do not let Nagle delay the body of keep-alive responses
+  disable_nagle_algorithm = True
+  mock = None
+
+  def do_GET(self):
+    self._reply(self.mock._respond(self.path, self.headers))
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('content-length', 0)))
+    self._reply(self.mock._respond(self.path, self.headers, body))
+
+  def _reply(self, response):
+    status, headers, body, latency = response
+    if latency:
+      time.sleep(latency)
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header('content-length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class MockChartServer:
+  """HTTP server answering like the Image-Charts /chart endpoint, in a background thread
+
+  - host :str - interface to listen on
+  - port :int - port to listen on, 0 picks a free port
+  - pathname :str - path of the chart endpoint, other paths answer 404
+  - latency :float - seconds to wait before each response
+  - accounts :dict - {account_id: secret_key} of the enterprise accounts accepted with icac
+  - png :bytes - body of PNG charts
+  - gif :bytes - body of animated (chan) charts
+  - max_age :int - Cache-Control max-age of the charts, in seconds (no Cache-Control header when None)
+  - max_url_length :int - longer request urls answer 414 URI Too Long, like servers and proxies limiting request lines
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, pathname='/chart', latency=0, accounts=None, png=PNG, gif=GIF, max_age=None, max_url_length=None) -> None:
+    self.host = host
+    self.pathname = pathname
+    self.latency = latency
+    self.accounts = accounts if accounts is not None else {}
+    self.png = png
+    self.gif = gif
+    self.max_age = max_age
+    self.max_url_length = max_url_length
+    self.request_count = 0
+    self.last_request = None
+    self.last_body = None
+    self._port = port
+    self._server = None
+    self._scripted = deque()
+    self._lock = threading.Lock()
+
+  @property
+  def port(self):
+    return self._server.server_address[1] if self._server is not None else self._port
+
+  def start(self):
+    """Start serving in a daemon thread, return the server"""
+    handler = type('MockChartHandler', (_MockChartHandler,), {'mock': self})
+    self._server = _ThreadingHTTPServer((self.host, self._port), handler)
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def options(self, opts=None):
+    """ImageCharts options pointing to this server, extended with opts"""
+    options = {'protocol': 'http', 'host': self.host, 'port': self.port, 'pathname': self.pathname}
+    options.update(opts or {})
+    return options
+
+  def enqueue(self, status, headers=None, body=b'', latency=None):
+    """Answer the next request with this response, whatever the chart (responses are served in queue order)"""
+    with self._lock:
+      self._scripted.append((status, dict(headers or {}), body, latency))
+
+  def rate_limit(self, count=1, retry_after=1):
+    """Answer the next count requests with 429 Too Many Requests and a Retry-After header"""
+    for _ in range(count):
+      self.enqueue(429, {'retry-after': str(retry_after), 'x-ic-error-code': 'IC_RATE_LIMITED'})
+
+  def _respond(self, path, request_headers, body=None):
+    with self._lock:
+      self.request_count += 1
+      self.last_request = (path, {name.lower(): value for name, value in request_headers.items()})
+      self.last_body = body
+      if self._scripted:
+        status, headers, body, latency = self._scripted.popleft()
+        return status, headers, body, self.latency if latency is None else latency
+
+    if self.max_url_length is not None and len(path) > self.max_url_length:
+      return self._error(414, 'IC_URI_TOO_LONG', 'request url is longer than {length} characters'.format(length=self.max_url_length))
+
+    url = urlsplit(path)
+    if url.path != self.pathname:
+      return self._error(404, 'IC_NOT_FOUND', 'unknown path "{path}"'.format(path=url.path))
+
+    query_string = url.query if body is None else self._body_query_string(body, request_headers.get('content-type', ''))
+    if query_string is None:
+      return self._error(400, 'IC_INVALID_BODY', 'POST body must be a form or a JSON object of chart parameters')
+
+    query = dict(parse_qsl(query_string, keep_blank_values=True))
+    if 'icac' in query:
+      error = self._check_signature(query_string, query)
+      if error is not None:
+        return error
+
+    messages = validate_query(query)
+    if messages:
+      return self._error(400, 'IC_VALIDATION_ERROR', *messages)
+
+    body = self.gif if 'chan' in query else self.png
+    etag = hashlib.sha1((url.path + '?' + query_string).encode('utf-8')).hexdigest()
+    headers = {'content-type': 'image/gif' if 'chan' in query else 'image/png', 'etag': '"{}"'.format(etag)}
+    if self.max_age is not None:
+      headers['cache-control'] = 'max-age={max_age}'.format(max_age=self.max_age)
+    if request_headers.get('if-none-match') == headers['etag']:
+      return 304, headers, b'', self.latency
+    return 200, headers, body, self.latency
+
+  def _body_query_string(self, body, content_type):
+    # query string equivalent to a POST body, ichm last like in signed urls, None when the body is invalid
+    try:
+      if content_type.startswith('application/json'):
+        params = json.loads(body.decode('utf-8'))
+        if not isinstance(params, dict):
+          return None
+        signature = params.pop('ichm', None)
+        query_string = '&'.join(param + '=' + quote_plus(str(value)) for param, value in params.items())
+        return query_string if signature is None else query_string + '&ichm=' + quote_plus(str(signature))
+      return body.decode('ascii')
+    except ValueError:
+      return None
+
+  def _check_signature(self, query_string, query):
+    if 'ichm' not in query:
+      return self._error(403, 'IC_MISSING_SIGNATURE', 'The HMAC-SHA256 request signature (ichm) is required when icac is defined')
+    secret = self.accounts.get(query['icac'])
+    if secret is None:
+      return self._error(403, 'IC_ACCOUNT_NOT_FOUND', 'you must be an Image-Charts subscriber to use icac, account "{icac}" not found'.format(icac=query['icac']))
+    signed_part = query_string.split('&ichm=')[0]
+    signature = hmac.new(secret.encode('utf-8'), signed_part.encode('utf-8'), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, query['ichm']):
+      return self._error(403, 'IC_INVALID_SIGNATURE', 'The HMAC-SHA256 request signature (ichm) does not match the query')
+    return None
+
+  def _error(self, status, error_code, *messages):
+    headers = {'x-ic-error-code': error_code, 'x-ic-error-validation': json.dumps([{'message': message} for message in messages])}
+    return status, headers, b'', self.latency
+
+class _FakeResponse:
+  def __init__(self, status_code, headers, content) -> None:
+    self.status_code = status_code
+    self.headers = headers
+    self.content = content
+    self.elapsed = None
+
+  def iter_content(self, chunk_size=1):
+    for offset in range(0, len(self.content), chunk_size):
+      yield self.content[offset:offset + chunk_size]
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+class FakeTransport:
+  """In-process transport answering like MockChartServer, for the 'transport' option of ImageCharts
+
+  A latency longer than the read timeout raises ImageChartsTimeoutError once the timeout is elapsed.
+
+  - server :MockChartServer - server (not started) computing the responses, created from kwargs when None
+  """
+
+  def __init__(self, server=None, **kwargs) -> None:
+    self.server = server if server is not None else MockChartServer(**kwargs)
+
+  def get(self, url, headers, timeout, stream=False):
+    return self._send(url, headers, timeout)
+
+  def post(self, url, headers, body, timeout, stream=False):
+    return self._send(url, headers, timeout, body)
+
+  def _send(self, url, headers, timeout, body=None):
+    parts = urlsplit(url)
+    path = parts.path + '?' + parts.query if parts.query else parts.path
+    status, response_headers, body, latency = self.server._respond(path, {name.lower(): value for name, value in headers.items()}, body)
+    if latency and latency > timeout[1]:
+      time.sleep(timeout[1])
+      raise ImageChartsTimeoutError(message='read timed out')
+    if latency:
+      time.sleep(latency)
+    return _FakeResponse(status, response_headers, body)
+
+  def close(self):
+    pass
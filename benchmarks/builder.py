@@ -0,0 +1,87 @@
+# Micro-benchmark of the fluent builder
+# $ python benchmarks/builder.py
+#
+# Compares the chained builder with the previous one, which copied the options and the whole
+# query dict on every parameter call: time to build a 15 parameters chart, memory retained by
+# 1000 variants derived from the same base chart (before and after their query is built, as
+# to_url() does), and by the last chart of a live loop updating chd 20000 times.
+
+import sys, timeit, tracemalloc
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts
+
+PARAMS = [
+  ('cht', 'lc'), ('chs', '700x300'), ('chco', 'FF0000'), ('chf', 'bg,s,FFFFFF'), ('chxt', 'x,y'),
+  ('chxl', '0:|a|b|c'), ('chtt', 'Title'), ('chts', '000000,20'), ('chls', '2'), ('chma', '10,10,10,10'),
+  ('chdl', 'serie'), ('chdlp', 'b'), ('icff', 'Roboto'), ('icfs', 'bold'), ('chd', 'a:1,2,3,4,5')
+]
+
+class CopyingImageCharts:
+  """Previous builder: every parameter call copies the options and the whole query dict"""
+
+  def __init__(self, options=None, previous=None):
+    options = options or {}
+    self.protocol = options.get('protocol', 'https')
+    self.host = options.get('host', 'image-charts.com')
+    self.port = options.get('port', 443)
+    self.pathname = options.get('pathname', '/chart')
+    self.timeout = options.get('timeout', 5000)
+    self.secret = options.get('secret')
+    self.user_agent = options.get('user_agent')
+    self.query = previous or {}
+    self.request_headers = {}
+    self.response_headers = {}
+
+  def set(self, param, value):
+    return CopyingImageCharts({
+      'protocol': self.protocol, 'host': self.host, 'port': self.port, 'pathname': self.pathname,
+      'timeout': self.timeout, 'secret': self.secret, 'user_agent': self.user_agent
+    }, {**self.query, **{param: value}})
+
+def build_copying(chart, params):
+  for param, value in params:
+    chart = chart.set(param, value)
+  return chart
+
+def build_chained(chart, params):
+  for param, value in params:
+    chart = getattr(chart, param)(value)
+  return chart
+
+def retained_kib(build, base):
+  # (before, after) building the query of the variants
+  tracemalloc.start()
+  start, _ = tracemalloc.get_traced_memory()
+  variants = [build(base, [('chd', 'a:{}'.format(i))]) for i in range(1000)]
+  built, _ = tracemalloc.get_traced_memory()
+  for variant in variants:
+    variant.query
+  end, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del variants
+  return (built - start) / 1024, (end - start) / 1024
+
+def live_loop_kib(build, base):
+  tracemalloc.start()
+  start, _ = tracemalloc.get_traced_memory()
+  chart = base
+  for i in range(20000):
+    chart = build(chart, [('chd', 'a:{}'.format(i))])
+    chart.query
+  end, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return (end - start) / 1024
+
+if __name__ == '__main__':
+  runs = 20000
+  for name, build, root in (
+    ('copying builder (previous)', build_copying, CopyingImageCharts),
+    ('chained builder', build_chained, ImageCharts)
+  ):
+    seconds = min(timeit.repeat(lambda: build(root(), PARAMS), number=runs, repeat=3))
+    base = build(root(), PARAMS[:-1])
+    before, after = retained_kib(build, base)
+    print('{name:<28} {us:8.2f} us/chart {before:8.1f} KiB for 1000 variants, {after:8.1f} KiB once built, {live:8.1f} KiB after a 20000 updates loop'.format(
+      name=name, us=seconds / runs * 1e6, before=before, after=after, live=live_loop_kib(build, base)))
@@ -0,0 +1,78 @@
+# Download throughput against the local mock server
+# $ python benchmarks/download.py [charts] [latency_ms]
+#
+# Renders the same batch of charts one at a time with a new connection per chart, one at a time
+# on a keep-alive session, from a thread pool (render_many) with the requests and httpx transports,
+# and from an event loop (requires aiohttp). The mock server speaks HTTP/1.1 over plain http, so
+# HTTP2Transport falls back to HTTP/1.1 here: it shows the httpx overhead, not HTTP/2 multiplexing.
+
+import sys, time, asyncio
+
+sys.path.insert(0, '.')
+
+import requests
+from ImageCharts import ImageCharts, create_session, create_async_session, HTTP2Transport
+from ImageChartsMockServer import MockChartServer
+
+def charts(server, count, options=None):
+  chart = ImageCharts(server.options(options)).cht('bvg').chs('300x300')
+  return [chart.chd('a:{},40'.format(i)) for i in range(count)]
+
+def sequential(server, count):
+  # a new session per chart, so a new connection per chart
+  for i in range(count):
+    with requests.Session() as session:
+      ImageCharts(server.options({'session': session})).cht('bvg').chs('300x300').chd('a:{},40'.format(i)).to_binary()
+
+def pooled(server, count):
+  for chart in charts(server, count, {'session': create_session()}):
+    chart.to_binary()
+
+def threaded(server, count):
+  for result in ImageCharts.render_many(charts(server, count, {'session': create_session(pool_maxsize=16)}), concurrency=16):
+    if result.error:
+      raise result.error
+
+def threaded_httpx(server, count):
+  transport = HTTP2Transport(max_connections=16)
+  try:
+    for result in ImageCharts.render_many(charts(server, count, {'transport': transport}), concurrency=16):
+      if result.error:
+        raise result.error
+  finally:
+    transport.close()
+
+def concurrent_async(server, count):
+  async def render():
+    session = create_async_session(limit=16)
+    try:
+      await asyncio.gather(*[chart.to_binary_async() for chart in charts(server, count, {'async_session': session})])
+    finally:
+      await session.close()
+  asyncio.new_event_loop().run_until_complete(render())
+
+def report(name, fn, server, count):
+  start = time.perf_counter()
+  fn(server, count)
+  elapsed = time.perf_counter() - start
+  print('{name:<36} {rate:10,.1f} charts/s'.format(name=name, rate=count / elapsed))
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+  latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005
+  with MockChartServer(latency=latency) as server:
+    report('sequential, connection per chart', sequential, server, count)
+    report('sequential, keep-alive session', pooled, server, count)
+    report('render_many(concurrency=16)', threaded, server, count)
+    try:
+      import httpx, h2
+    except ImportError:
+      print('HTTP2Transport skipped, httpx[http2] is not installed')
+    else:
+      report('render_many(16), HTTP2Transport', threaded_httpx, server, count)
+    try:
+      import aiohttp
+    except ImportError:
+      print('to_binary_async() skipped, aiohttp is not installed')
+    else:
+      report('to_binary_async() x16 connections', concurrent_async, server, count)
@@ -0,0 +1,41 @@
+# Import time budget
+# $ python benchmarks/import_time.py [budget_ms]
+#
+# Measures `import ImageCharts` with `python -X importtime` in fresh interpreters (best of 5, bytecode
+# cached in a temporary pycache_prefix so source compilation is not counted) and fails when it exceeds
+# the budget or when building a url imports the network stack. The cost of the first download, which
+# imports requests, is reported for reference.
+
+import sys, os, subprocess, tempfile
+
+# hmac and hashlib are expected: signing needs them
+HEAVY_MODULES = ('requests', 'urllib3', 'asyncio', 'json', 'concurrent.futures', 'aiohttp')
+
+def run(code, pycache):
+  env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd='.', env=env,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+def cumulative_us(stderr, module):
+  for line in stderr.decode('utf-8').splitlines():
+    fields = [field.strip() for field in line.split('|')]
+    if len(fields) == 3 and fields[2] == module:
+      return int(fields[1])
+  return 0
+
+if __name__ == '__main__':
+  budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+  pycache = tempfile.mkdtemp()
+  run('import ImageCharts', pycache)
+
+  import_ms = min(cumulative_us(run('import ImageCharts', pycache).stderr, 'ImageCharts') for _ in range(5)) / 1000
+  requests_ms = min(cumulative_us(run('import ImageCharts, requests', pycache).stderr, 'requests') for _ in range(5)) / 1000
+  loaded = run('import sys, ImageCharts; ImageCharts.ImageCharts({"secret": "s"}).cht("p").icac("a").to_url(); '
+    'print(",".join(name for name in ' + repr(HEAVY_MODULES) + ' if name in sys.modules))', pycache).stdout.decode('utf-8').strip()
+
+  print('{name:<36} {ms:8.1f} ms (budget {budget:.1f} ms)'.format(name='import ImageCharts', ms=import_ms, budget=budget_ms))
+  print('{name:<36} {ms:8.1f} ms'.format(name='first download (import requests)', ms=requests_ms))
+  print('{name:<36} {modules}'.format(name='imported by to_url()', modules=loaded or 'none'))
+  if import_ms > budget_ms or loaded:
+    sys.exit(1)
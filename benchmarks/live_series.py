@@ -0,0 +1,39 @@
+# Redraw rate of a live chart appending one point per tick to a sliding window
+# $ python benchmarks/live_series.py [points]
+#
+# Each tick appends a point and builds the signed url of the chart: by re-encoding the whole window
+# with ImageChartsData.encode() and chaining chd(), or by appending to a DataSeries whose tokens and
+# url encoded tokens are kept, passed to a ChartTemplate.
+
+import sys, timeit, random
+from collections import deque
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts, ChartTemplate
+import ImageChartsData
+
+if __name__ == '__main__':
+  points = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  ticks = 500
+  values = [random.uniform(0, 1000) for _ in range(points + ticks)]
+  base = ImageCharts({'secret': 'SECRET_KEY'}).cht('lc').chs('700x300').icac('ACCOUNT_ID')
+
+  window = deque(values[:points], maxlen=points)
+  stream = iter(values[points:])
+
+  def rebuild():
+    window.append(next(stream))
+    base.chd(ImageChartsData.encode(list(window), 't')).chds(ImageChartsData.chds(list(window))).to_url()
+
+  series = ImageChartsData.DataSeries(values[:points], maxlen=points)
+  template = ChartTemplate(base)
+  incremental_stream = iter(values[points:])
+
+  def incremental():
+    series.append(next(incremental_stream))
+    template.to_url(chd=series.chd(), chds=series.chds())
+
+  for name, fn in (('encode() + chd() + to_url()', rebuild), ('DataSeries + ChartTemplate', incremental)):
+    seconds = timeit.timeit(fn, number=ticks)
+    print('{name:<32} {points:,} points {rate:12,.0f} ticks/s'.format(name=name, points=points, rate=ticks / seconds))
@@ -0,0 +1,38 @@
+# Peak memory of large chart downloads against the local mock server
+# $ python benchmarks/memory.py [size_mib]
+#
+# Compares buffering methods (to_binary, to_data_uri) with streaming ones (to_file, write_data_uri)
+# on a chart of size_mib MiB, peak traced by tracemalloc.
+
+import sys, os, tempfile, tracemalloc
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts
+from ImageChartsMockServer import MockChartServer, PNG
+
+def write_data_uri(chart):
+  with open(os.devnull, 'w') as fp:
+    chart.write_data_uri(fp)
+
+def peak_mib(fn):
+  tracemalloc.start()
+  fn()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return peak / 1024 / 1024
+
+if __name__ == '__main__':
+  size = float(sys.argv[1]) if len(sys.argv) > 1 else 16
+  body = PNG + b'\x00' * int(size * 1024 * 1024)
+  path = os.path.join(tempfile.mkdtemp(), 'chart.png')
+  with MockChartServer(png=body) as server:
+    chart = ImageCharts(server.options()).cht('bvg').chs('300x300').chd('a:10,40')
+    chart.to_binary()
+    for name, fn in (
+      ('to_binary()', chart.to_binary),
+      ('to_data_uri()', chart.to_data_uri),
+      ('to_file(path)', lambda: chart.to_file(path)),
+      ('write_data_uri(fp)', lambda: write_data_uri(chart)),
+    ):
+      print('{name:<32} {peak:8.1f} MiB peak for a {size:.0f} MiB chart'.format(name=name, peak=peak_mib(fn), size=size))
@@ -0,0 +1,32 @@
+# Size and speed of charts sent to process pools
+# $ python benchmarks/pickling.py [charts]
+#
+# Pickled size per chart, alone and in a batch (the config handle is pickled once per batch), then
+# pickle round trips per second and the url throughput of to_urls() with worker processes, which
+# sends the handle of the base chart and rows of varying parameters only.
+
+import sys, timeit, pickle
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts
+
+def base_chart():
+  return ImageCharts({'secret': 'SECRET_KEY', 'max_retries': 2}).cht('bvg').chs('700x300').chco('FF0000,00FF00').icac('ACCOUNT_ID')
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  base = base_chart()
+  charts = [base.chd('a:{},{},{}'.format(i, i + 1, i + 2)) for i in range(count)]
+
+  print('{:<36} {:12,} bytes'.format('pickled chart', len(pickle.dumps(charts[0]))))
+  print('{:<36} {:12,.1f} bytes'.format('pickled chart in a batch of {:,}'.format(count), len(pickle.dumps(charts)) / count))
+
+  runs = 20000
+  seconds = min(timeit.repeat(lambda: pickle.loads(pickle.dumps(charts[1])), number=runs, repeat=3))
+  print('{:<36} {:12,.0f} charts/s'.format('pickle round trip', runs / seconds))
+
+  rows = [{'chd': 'a:{},{},{}'.format(i, i + 1, i + 2)} for i in range(count)]
+  for processes in (None, 2):
+    seconds = min(timeit.repeat(lambda: list(base.to_urls(rows, processes=processes)), number=1, repeat=3))
+    print('{:<36} {:12,.0f} urls/s'.format('to_urls(processes={})'.format(processes), count / seconds))
@@ -0,0 +1,36 @@
+# Url building and signing throughput
+# $ python benchmarks/signing.py
+#
+# Time to build the url of an unsigned and of a signed (icac + secret) chart, with ImageCharts.to_url()
+# and with a ChartTemplate, which encodes the static parameters and hashes the secret once.
+# Then raw signatures per second: a fresh hmac.new() per signature hex-encoded through codecs (previous
+# to_url), a copy of the precomputed keyed state, and the memoized signature of an already signed query.
+
+import sys, timeit, hmac, hashlib, codecs
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts, ChartTemplate, _Signer
+
+def base_chart(options):
+  return ImageCharts(options).cht('bvg').chs('700x300').chco('FF0000,00FF00').chf('bg,s,FFFFFF').icff('Roboto')
+
+if __name__ == '__main__':
+  runs = 50000
+  for name, options, account in (('unsigned', {}, None), ('signed', {'secret': 'SECRET_KEY'}, 'ACCOUNT_ID')):
+    chart = base_chart(options).chd('a:1,2,3').chl('a|b|c')
+    chart = chart.icac(account) if account else chart
+    template = ChartTemplate(chart)
+    for method, fn in (('to_url()', chart.to_url), ('ChartTemplate.to_url()', lambda: template.to_url(chd='a:4,5,6'))):
+      seconds = min(timeit.repeat(fn, number=runs, repeat=3))
+      print('{name:<10} {method:<32} {rate:12,.0f} urls/s'.format(name=name, method=method, rate=runs / seconds))
+
+  query_string = base_chart({}).chd('a:1,2,3').chl('a|b|c').icac('ACCOUNT_ID').to_url().split('?')[1]
+  signer, unmemoized = _Signer('SECRET_KEY'), _Signer('SECRET_KEY', size=0)
+  for method, fn in (
+    ('hmac.new() + codecs (previous)', lambda: codecs.getencoder('hex')(hmac.new(b'SECRET_KEY', query_string.encode('utf-8'), hashlib.sha256).digest())[0].decode('utf-8')),
+    ('keyed state copy', lambda: unmemoized.sign(query_string)),
+    ('memoized', lambda: signer.sign(query_string)),
+  ):
+    seconds = min(timeit.repeat(fn, number=runs, repeat=3))
+    print('{name:<10} {method:<32} {rate:12,.0f} signatures/s'.format(name='sign', method=method, rate=runs / seconds))
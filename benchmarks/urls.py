@@ -0,0 +1,38 @@
+# Signed url generation throughput
+# $ python benchmarks/urls.py [rows]
+#
+# Compares building an ImageCharts per row and calling to_url() with the bulk to_urls() api,
+# in process and fanned out to a process pool.
+
+import sys, time, os
+
+sys.path.insert(0, '.')
+
+from ImageCharts import ImageCharts
+
+def rows(count):
+  return ({'chd': 'a:{},{},{}'.format(i, i + 1, i + 2), 'chl': 'a|b|{}'.format(i)} for i in range(count))
+
+def base_chart():
+  return ImageCharts({'secret': 'SECRET_KEY'}).icac('ACCOUNT_ID').cht('bvg').chs('700x300').chco('FF0000,00FF00').chf('bg,s,FFFFFF').icff('Roboto')
+
+def per_object(count):
+  for row in rows(count):
+    ImageCharts({'secret': 'SECRET_KEY'}).icac('ACCOUNT_ID').cht('bvg').chs('700x300').chco('FF0000,00FF00').chf('bg,s,FFFFFF').icff('Roboto').chd(row['chd']).chl(row['chl']).to_url()
+
+def bulk(count, processes=None):
+  for _ in base_chart().to_urls(rows(count), processes=processes, chunksize=5000):
+    pass
+
+def report(name, fn, count):
+  start = time.perf_counter()
+  fn(count)
+  elapsed = time.perf_counter() - start
+  print('{name:<32} {rate:12,.0f} urls/s'.format(name=name, rate=count / elapsed))
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  processes = os.cpu_count() or 1
+  report('ImageCharts(...).to_url()', per_object, count)
+  report('to_urls()', bulk, count)
+  report('to_urls(processes={})'.format(processes), lambda count: bulk(count, processes), count)
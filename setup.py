@@ -8,7 +8,10 @@ with open("README.md", "r") as fh:
 setup(
   name='image-charts',
   version="6.1.134",
-  py_modules=['ImageCharts'],
+  py_modules=['ImageCharts', 'ImageChartsData', 'ImageChartsMockServer', 'ImageChartsCLI'],
+  entry_points={
+    'console_scripts': ['image-charts=ImageChartsCLI:main'],
+  },
   url='https://github.com/image-charts/python',
   license='MIT',
   author='Francois-Guillaume Ribreau',
@@ -17,6 +20,10 @@ setup(
   long_description=long_description,
   long_description_content_type="text/markdown",
   install_requires=["requests>=2.24"],
+  extras_require={
+    'async': ["aiohttp>=3.7"],
+    'http2': ["httpx[http2]>=0.18"],
+  },
   python_requires='>=3.6',
   classifiers=[
     'License :: OSI Approved :: MIT License',